@@ -3,7 +3,6 @@
   lib,
   pexpect,
   pip,
-  ps,
   psutil,
   pyxdg,
   setproctitle,
@@ -38,12 +37,6 @@ buildPythonApplication {
     make test
   '';
 
-  postPatch = ''
-    # shtuff uses `ps` internally. Point that to a direct path to ps.
-    substituteInPlace shtuff.py \
-      --replace-fail "ps -p" "${ps}/bin/ps -p"
-  '';
-
   # Don't wrap the Python application. The problem with the wrappers
   # is that they set the `PATH` (and perhaps less importantly, the
   # `PYTHONNOUSERSITE`) environment variables (relevant nix code here:
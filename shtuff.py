@@ -1,40 +1,252 @@
 #!/usr/bin/env python3
 
+# `shtuff into` and friends get run a lot (e.g. by editor integrations on
+# every keystroke), so startup time matters. Only cheap modules are imported
+# up here. Heavier ones (pexpect, psutil, setproctitle, xdg, sqlite3,
+# concurrent.futures, importlib.metadata, ...) are imported by the functions
+# that need them, which the sending side mostly never calls.
 import os
 import sys
+import json
+import time
+import bisect
 import fcntl
 import base64
-import psutil
 import signal
+import socket
+import selectors
 import struct
-import pexpect
+import itertools
 import termios
 import argparse
-import subprocess
-import setproctitle
-import xdg.BaseDirectory
+import threading
 
 from textwrap import dedent
-from importlib.metadata import version, PackageNotFoundError
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+PROC_DIR = "/proc"
+
+# A receiver is identified by its pid plus the time it started, so a pid that
+# got reused by some other process isn't mistaken for the receiver that
+# registered it. start_time may be None for receivers registered by older
+# versions of shtuff. One process can host many receivers (see Supervisor),
+# in which case slot tells them apart.
+Receiver = namedtuple("Receiver", ["pid", "start_time", "slot"], defaults=[None])
+
+_data_dir = None
 
 
 def data_dir(file=None):
-    data_dir = xdg.BaseDirectory.save_data_path("shtuff")
+    global _data_dir
+    if _data_dir is None:
+        with trace("data_dir"):
+            import xdg.BaseDirectory
+
+            try:
+                _data_dir = xdg.BaseDirectory.save_data_path("shtuff")
+            except FileExistsError:
+                # Somebody else created it between pyxdg checking whether it
+                # exists and creating it.
+                _data_dir = xdg.BaseDirectory.save_data_path("shtuff")
 
     if file is None:
-        return data_dir
+        return _data_dir
+
+    return os.path.join(_data_dir, file)
+
+
+# Set by start_tracing() if SHTUFF_TRACE names a file to log spans to.
+_tracer = None
+
+
+class Tracer:
+    """
+    Logs spans (how long each phase of what a process does took) as JSON
+    lines to the file named by SHTUFF_TRACE. Every span has the trace id of
+    whatever it was part of: the spans a CLI invocation logs share one, which
+    it passes on with the commands it stuffs, so the receiver's spans for
+    them can be matched up with the sender's.
+    """
+
+    def __init__(self, path):
+        # O_APPEND, and a single write per span, so spans from several
+        # processes tracing into the same file don't get mixed up.
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.trace_id = os.urandom(8).hex()
+
+    def log(self, name, start, trace_id=None, **fields):
+        """
+        Log a span that started at the given time (by time.monotonic(), which
+        is the same clock in every process) and ends now.
+        """
+        span = {
+            "trace": trace_id or self.trace_id,
+            "span": name,
+            "pid": os.getpid(),
+            "start": start,
+            "duration": time.monotonic() - start,
+            **fields,
+        }
+        os.write(self.fd, json.dumps(span).encode("utf8") + b"\n")
+
+
+class Span:
+    """
+    Logs a span covering its body. See trace().
+    """
+
+    def __init__(self, tracer, name, fields):
+        self.tracer = tracer
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.note(error=exc_type.__name__)
+        self.tracer.log(self.name, self.start, **self.fields)
+
+    def note(self, **fields):
+        """
+        Add the given fields to the span.
+        """
+        self.fields.update(fields)
+
+
+class NoSpan:
+    """
+    What trace() returns when tracing is off.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def note(self, **fields):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def trace(name, **fields):
+    """
+    Return a context manager that logs a span with the given name (and extra
+    fields) covering its body, if tracing is on. If it isn't, this does
+    nothing at all.
+    """
+    if _tracer is None:
+        return NO_SPAN
+
+    return Span(_tracer, name, fields)
+
+
+def start_tracing():
+    """
+    Turn tracing on if SHTUFF_TRACE is set (or off if it isn't), and log how
+    long this process took to start up, which is mostly the interpreter
+    starting and importing things.
+    """
+    global _tracer
+    if _tracer is not None:
+        os.close(_tracer.fd)
+        _tracer = None
+
+    path = os.environ.get("SHTUFF_TRACE")
+    if not path:
+        return
+
+    try:
+        _tracer = Tracer(path)
+    except OSError as e:
+        # Tracing is no reason for the command itself to fail.
+        print(f"Warning: not tracing: {e}", file=sys.stderr)
+        return
+
+    if os.path.isdir(PROC_DIR):
+        # In seconds since boot. We only know when we started to the clock
+        # tick (usually 10ms).
+        started_at = int(read_proc_stat(os.getpid())[19]) / os.sysconf("SC_CLK_TCK")
+        age = time.clock_gettime(time.CLOCK_BOOTTIME) - started_at
+    else:
+        import psutil
+
+        age = time.time() - psutil.Process().create_time()
+
+    _tracer.log("startup", time.monotonic() - max(age, 0))
+
+
+def get_version():
+    from importlib.metadata import version, PackageNotFoundError
+
+    try:
+        return version(__name__)
+    except PackageNotFoundError:
+        # package is not installed
+        return "development"
+
 
-    return os.path.join(data_dir, file)
+def __getattr__(name):
+    # Looking up our version is slow, so `__version__` is only computed when
+    # somebody actually asks for it.
+    if name == "__version__":
+        return get_version()
 
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-try:
-    __version__ = version(__name__)
-except PackageNotFoundError:
-    # package is not installed
-    __version__ = "development"
+
+class VersionAction(argparse.Action):
+    """
+    Like argparse's "version" action, but only looks the version up when it
+    is asked for.
+    """
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, **kwargs):
+        super().__init__(
+            option_strings,
+            dest=dest,
+            default=argparse.SUPPRESS,
+            nargs=0,
+            help="show program's version number and exit",
+            **kwargs,
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.exit(message=f"{get_version()}\n")
 
 
 def main():
+    start_tracing()
+    with trace("parse_args"):
+        func, args = parse_args()
+
+    if func is not None:
+        with trace(func.__name__):
+            func(**args)
+
+
+def positive_float(value):
+    """
+    An argparse type for a number of seconds that has to be more than 0.
+    """
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"must be more than 0, not {value}")
+
+    return number
+
+
+def parse_args():
+    """
+    Return the function for the action given on the command line, and the
+    arguments to call it with.
+    """
     parser = argparse.ArgumentParser(
         description="Shtuff will stuff commands into a shell à la tmux send-keys or screen stuff",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -58,14 +270,31 @@ def main():
                 running tail.
         """),
     )
-    parser.add_argument("-v", "--version", action="version", version=__version__)
+    parser.add_argument("-v", "--version", action=VersionAction)
     subparsers = parser.add_subparsers(metavar="action")
 
+    def add_supervised_argument(parser):
+        parser.add_argument(
+            "--supervised",
+            action="store_true",
+            help="run the shell in the running `shtuff supervisor` rather than in a process of its own",
+        )
+
     parser_as = subparsers.add_parser("as", help="become a receiving shell")
     parser_as.add_argument(
         "name",
         help="the current shell will take this name, use `shtuff into` to send commands here",
     )
+    parser_as.add_argument(
+        "-g",
+        "--group",
+        dest="groups",
+        action="append",
+        default=[],
+        metavar="GROUP",
+        help="also join the given group, use `shtuff into --group` to send commands to every member",
+    )
+    add_supervised_argument(parser_as)
     parser_as.set_defaults(func=shtuff_as)
 
     def add_newline_argument(parser):
@@ -82,10 +311,113 @@ def main():
     parser_into.add_argument(
         "name", help="the name of the shell to send the given command to"
     )
-    parser_into.add_argument("cmd", help="the command to send to the shell")
+    parser_into.add_argument(
+        "cmd",
+        nargs="?",
+        help="the command to send to the shell, or - to stream stdin to it as is (optional with --interrupt or --cancel)",
+    )
     add_newline_argument(parser_into)
+    broadcast_group = parser_into.add_mutually_exclusive_group()
+    broadcast_group.add_argument(
+        "--glob",
+        action="store_true",
+        help="treat name as a glob pattern and send to every matching shell",
+    )
+    broadcast_group.add_argument(
+        "--group",
+        action="store_true",
+        help="treat name as a group and send to every shell in it",
+    )
+    parser_into.add_argument(
+        "--ack",
+        action="store_true",
+        help="wait until the command has been typed into the shell",
+    )
+    parser_into.add_argument(
+        "--wait",
+        action="store_true",
+        help="wait until the command is done, and print how many seconds that took",
+    )
+    parser_into.add_argument(
+        "--quiet",
+        type=float,
+        metavar="SECONDS",
+        help=f"with --wait, the command is done once the shell prints nothing for SECONDS (default: {DEFAULT_QUIET})",
+    )
+    parser_into.add_argument(
+        "--prompt",
+        metavar="REGEX",
+        help="with --wait, the command is done once the shell prints something matching REGEX",
+    )
+    parser_into.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="give up waiting after SECONDS",
+    )
+    parser_into.add_argument(
+        "--defer",
+        action="store_true",
+        help="if there's no such shell yet, queue the command up for it to run as soon as it shows up",
+    )
+    parser_into.add_argument(
+        "--ttl",
+        type=positive_float,
+        default=DEFAULT_DEFER_TTL,
+        metavar="SECONDS",
+        help=f"with --defer, forget the command if the shell doesn't show up within SECONDS (default: {DEFAULT_DEFER_TTL})",
+    )
+    parser_into.add_argument(
+        "--priority",
+        action="store_true",
+        help="send the command ahead of any commands still waiting to be typed into the shell",
+    )
+    parser_into.add_argument(
+        "--interrupt",
+        action="store_true",
+        help="like --priority, but first stop typing in whatever command is being typed in, and press Ctrl-C",
+    )
+    parser_into.add_argument(
+        "--cancel",
+        action="store_true",
+        help="like --priority, but throw away any commands still waiting to be typed into the shell",
+    )
     parser_into.set_defaults(func=shtuff_into)
 
+    parser_batch = subparsers.add_parser(
+        "batch",
+        help="send many commands to many receiving shells at once",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=dedent("""\
+            Every line of the manifest names a shell and what to send it:
+              shell-a cd ~/project
+              shell-a make
+              shell-b tail -f /var/log/somelog.log
+
+            Each shell gets its commands in order, but shells don't wait for
+            each other. A line can also be one of these instead of a command:
+              shell-a @wait [SECONDS]  wait for the previous command to be
+                                       done (quiet for SECONDS)
+              shell-a @sleep SECONDS   wait SECONDS before the next command
+
+            Empty lines and lines starting with # are ignored.
+        """),
+    )
+    parser_batch.add_argument(
+        "manifest",
+        nargs="?",
+        default="-",
+        help="the file to read commands from (default: stdin)",
+    )
+    add_newline_argument(parser_batch)
+    parser_batch.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="give up on a shell if it doesn't respond within SECONDS",
+    )
+    parser_batch.set_defaults(func=shtuff_batch)
+
     parser_new = subparsers.add_parser(
         "new", help="start a new shell and immediately send a command"
     )
@@ -93,6 +425,7 @@ def main():
         "cmd", help="start a new shell and immediately run the given command"
     )
     add_newline_argument(parser_new)
+    add_supervised_argument(parser_new)
     parser_new.set_defaults(func=shtuff_new)
 
     parser_has = subparsers.add_parser(
@@ -103,197 +436,3996 @@ def main():
     )
     parser_has.set_defaults(func=shtuff_has)
 
+    parser_wait = subparsers.add_parser(
+        "wait", help="wait until the given targets are available to receive commands"
+    )
+    parser_wait.add_argument(
+        "names", nargs="+", metavar="name", help="the name of a shell to wait for"
+    )
+    parser_wait.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="give up waiting after SECONDS",
+    )
+    parser_wait.set_defaults(func=shtuff_wait)
+
     parser_whoami = subparsers.add_parser(
         "whoami", help="print any found receiver names for the current shtuff shell"
     )
     parser_whoami.set_defaults(func=shtuff_whoami)
 
+    parser_ls = subparsers.add_parser(
+        "ls", help="list the names of all receiving shells, and forget dead ones"
+    )
+    parser_ls.set_defaults(func=shtuff_ls)
+
+    parser_tail = subparsers.add_parser(
+        "tail", help="print what a receiving shell has recently printed"
+    )
+    parser_tail.add_argument("name", help="the name of the shell to look at")
+    parser_tail.add_argument(
+        "-n",
+        dest="size",
+        type=int,
+        metavar="BYTES",
+        help="only print the last BYTES bytes",
+    )
+    parser_tail.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        help="keep printing whatever the shell prints from now on",
+    )
+    parser_tail.set_defaults(func=shtuff_tail)
+
+    parser_attach = subparsers.add_parser(
+        "attach", help="watch what a receiving shell prints, without typing into it"
+    )
+    parser_attach.add_argument("name", help="the name of the shell to watch")
+    parser_attach.set_defaults(func=shtuff_attach)
+
+    parser_stats = subparsers.add_parser(
+        "stats", help="show what receiving shells have been up to"
+    )
+    parser_stats.add_argument(
+        "name", nargs="?", help="the name of the shell to look at (default: all)"
+    )
+    parser_stats.add_argument(
+        "--json",
+        dest="as_json",
+        action="store_true",
+        help="print everything there is to know, as one JSON object per shell",
+    )
+    parser_stats.set_defaults(func=shtuff_stats)
+
+    parser_broker = subparsers.add_parser(
+        "broker",
+        help="keep track of receiving shells in memory, to speed up every other command",
+    )
+    parser_broker.set_defaults(func=shtuff_broker)
+
+    parser_supervisor = subparsers.add_parser(
+        "supervisor",
+        help="host the receiving shells started with --supervised, all in one process",
+    )
+    parser_supervisor.set_defaults(func=shtuff_supervisor)
+
+    parser_zygote = subparsers.add_parser(
+        "zygote",
+        help="fork receiving shells from a warmed up process, so they start faster",
+    )
+    parser_zygote.set_defaults(func=shtuff_zygote)
+
     args = vars(parser.parse_args())
     if not args:
-        return parser.print_help()
+        parser.print_help()
+        return None, None
 
-    func = args.pop("func")
-    func(**args)
+    return args.pop("func"), args
 
 
-def shtuff_as(name):
-    pid = find_nearest_shtuff_process()
+def shtuff_as(name, groups, supervised):
+    receiver = find_nearest_receiver()
 
-    if not pid:
-        spawn_and_stuff(os.environ["SHELL"], name=name)
+    if receiver is None:
+        start_receiver(
+            os.environ["SHELL"], name=name, groups=groups, supervised=supervised
+        )
         return
 
-    write_shtuff_pid(name, pid)
+    if receiver.slot is None and is_supervisor(receiver.pid):
+        # We're in a supervised shell, but can't tell which one.
+        print(
+            "Error: can't tell which supervised shell this is, is SHTUFF_RECEIVER unset?",
+            file=sys.stderr,
+        )
+        exit(1)
 
+    deferred = write_shtuff_pid(name, receiver.pid, groups, receiver.slot)
+    for data in deferred:
+        reply, error = try_stuff_into(receiver, name, data)
+        if error is not None:
+            print(error, file=sys.stderr)
+            exit(1)
 
-def write_shtuff_pid(name, pid):
-    pid_file = get_pid_file(name)
-    with open(pid_file, "w") as f:
-        f.write(str(pid))
 
+def write_shtuff_pid(name, pid, groups=(), slot=None):
+    """
+    Register the given name for the receiver with the given pid (and slot).
+    Returns the commands that were deferred until it showed up (see
+    defer_stuff()), in order, for the caller to stuff into it.
+    """
+    receiver = get_receiver(pid)._replace(slot=slot)
+    with registry_transaction() as registry:
+        registry.execute(
+            "INSERT OR REPLACE INTO receivers (name, pid, start_time, slot)"
+            " VALUES (?, ?, ?, ?)",
+            (name, *receiver),
+        )
+        registry.executemany(
+            "INSERT OR IGNORE INTO groups (grp, name) VALUES (?, ?)",
+            [(group, name) for group in groups],
+        )
 
-def shtuff_into(name, cmd, newline):
-    if newline:
-        cmd += "\n"
+        now = time.time()
+        registry.execute("DELETE FROM deferred WHERE expires_at <= ?", (now,))
+        deferred = [
+            data
+            for (data,) in registry.execute(
+                "SELECT data FROM deferred WHERE name = ? ORDER BY id", (name,)
+            )
+        ]
+        registry.execute("DELETE FROM deferred WHERE name = ?", (name,))
 
-    pid_file = get_pid_file(name)
-    if not os.path.exists(pid_file):
-        print_target_not_found(name)
-        exit(1)
+    ask_broker(
+        {"op": "register", "name": name, "receiver": receiver, "groups": list(groups)}
+    )
 
-    pid = get_pid_from_file(pid_file)
+    # Let anybody in `shtuff wait` know (see DirectoryWatcher).
+    os.utime(data_dir())
 
-    with open(get_cmd_file(pid), "w") as f:
-        f.write(cmd)
+    return deferred
 
-    if shtuff_process_has_terminated(pid):
-        print_target_not_found(name)
+
+def defer_stuff(name, data, ttl):
+    """
+    Queue up the given bytes for the receiver by the given name, which isn't
+    running yet, for it to get once it registers (see write_shtuff_pid()).
+    They're dropped if that doesn't happen within ttl seconds. Returns None,
+    or the receiver if it turns out to have registered in the meantime.
+    """
+    # Registering happens in a transaction too, so either the receiver sees
+    # what we queue up, or we see the receiver.
+    with registry_transaction() as registry:
+        row = registry.execute(
+            "SELECT pid, start_time, slot FROM receivers WHERE name = ?", (name,)
+        ).fetchone()
+        if row is not None and not shtuff_process_has_terminated(*row):
+            return Receiver(*row)
+
+        registry.execute(
+            "INSERT INTO deferred (name, data, expires_at) VALUES (?, ?, ?)",
+            (name, data, time.time() + ttl),
+        )
+
+    return None
+
+
+# How many seconds a shell has to go without printing anything for `shtuff
+# into --wait` to consider its command done.
+DEFAULT_QUIET = 0.5
+
+# How many seconds `shtuff into --defer` keeps a command around for a shell
+# that hasn't shown up yet.
+DEFAULT_DEFER_TTL = 60
+
+
+def shtuff_into(
+    name,
+    cmd,
+    newline,
+    glob,
+    group,
+    ack=False,
+    wait=False,
+    quiet=None,
+    prompt=None,
+    timeout=None,
+    defer=False,
+    ttl=DEFAULT_DEFER_TTL,
+    priority=False,
+    interrupt=False,
+    cancel=False,
+):
+    if defer and (glob or group):
+        print("Error: --defer only works with a single name.", file=sys.stderr)
         exit(1)
 
-    os.kill(pid, signal.SIGUSR1)
+    if defer and (ack or wait):
+        print("Error: --defer can't be combined with --ack or --wait.", file=sys.stderr)
+        exit(1)
 
+    priority = get_priority_options(priority, interrupt, cancel)
+    if defer and priority is not None:
+        print(
+            "Error: --defer can't be combined with --priority, --interrupt or --cancel.",
+            file=sys.stderr,
+        )
+        exit(1)
 
-def shtuff_new(cmd, newline):
-    if newline:
-        cmd += "\n"
+    if cmd is None:
+        if not (interrupt or cancel):
+            print(
+                "Error: a command is needed unless you pass --interrupt or --cancel.",
+                file=sys.stderr,
+            )
+            exit(1)
 
-    spawn_and_stuff(os.environ["SHELL"], to_stuff=cmd)
+        # Just interrupt, or cancel.
+        data = b""
+    elif cmd == "-":
+        # Stream stdin as is, rather than reading it all into memory first.
+        data = sys.stdin.buffer
+    else:
+        if newline:
+            cmd += "\n"
 
+        data = cmd.encode("utf8")
 
-def shtuff_has(name):
-    pid_file = get_pid_file(name)
+    import re
 
-    if not os.path.exists(pid_file):
-        print_target_not_found(name)
+    try:
+        wait = get_wait_options(ack, wait, quiet, prompt)
+    except re.error as e:
+        print(f"Error: invalid --prompt: {e}", file=sys.stderr)
         exit(1)
 
-    pid = get_pid_from_file(pid_file)
+    if not (glob or group):
+        receiver = lookup_receiver(name)
+        if defer and (receiver is None or shtuff_process_has_terminated(*receiver)):
+            if not isinstance(data, bytes):
+                data = data.read()
+            receiver = defer_stuff(name, data, ttl)
+            if receiver is None:
+                return
+
+        if receiver is None:
+            print_target_not_found(name)
+            exit(1)
+
+        reply, error = try_stuff_into(receiver, name, data, wait, timeout, priority)
+        if error is not None:
+            print(error, file=sys.stderr)
+            exit(1)
+
+        if "latency" in reply:
+            print(f"{reply['latency']:.3f}")
+
+        return
+
+    from fnmatch import fnmatchcase
+    from concurrent.futures import ThreadPoolExecutor
 
-    if shtuff_process_has_terminated(pid):
+    if glob:
+        candidates = {
+            target: receiver
+            for target, receiver in read_registry().items()
+            if fnmatchcase(target, name)
+        }
+    else:
+        candidates = get_group_members(name)
+
+    # Several names may refer to the same receiver, but each receiver should
+    # only get the command once.
+    targets = get_live_targets(candidates)
+    if not targets:
         print_target_not_found(name)
         exit(1)
 
-    print(f"Shtuff process {name} was found with pid of {pid}.")
+    if not isinstance(data, bytes):
+        # Every receiver needs its own copy of stdin.
+        data = data.read()
 
+    with ThreadPoolExecutor(max_workers=min(len(targets), 32)) as executor:
+        results = dict(
+            zip(
+                targets,
+                executor.map(
+                    lambda receiver: try_stuff_into(
+                        receiver, targets[receiver], data, wait, timeout, priority
+                    ),
+                    targets,
+                ),
+            )
+        )
 
-def shtuff_whoami():
-    pid = find_nearest_shtuff_process()
+    for receiver in sorted(targets, key=targets.get):
+        reply, error = results[receiver]
+        if error is not None:
+            print(error, file=sys.stderr)
+        elif "latency" in reply:
+            print(f"Stuffed into {targets[receiver]} ({reply['latency']:.3f}s).")
+        else:
+            print(f"Stuffed into {targets[receiver]}.")
 
-    if pid is None:
-        print(
-            "Error: this is not a shtuff shell. Use 'shtuff new' or 'shtuff as' to make one.",
-            file=sys.stderr,
-        )
-        sys.exit(1)
+    if any(error is not None for reply, error in results.values()):
+        exit(1)
 
-    pid_files = [x for x in os.listdir(data_dir()) if os.path.splitext(x)[1] == ".pid"]
-    receivers = sorted(
-        get_unsafe_name(x) for x in pid_files if get_pid_from_file(data_dir(x)) == pid
-    )
 
-    if len(receivers) == 0:
-        print(
-            "Warning: this shtuff has no name. Use 'shtuff as' to give it a name.",
-            file=sys.stderr,
-        )
+def shtuff_batch(manifest, newline, timeout):
+    try:
+        if manifest == "-":
+            steps = parse_manifest(sys.stdin)
+        else:
+            with open(manifest) as f:
+                steps = parse_manifest(f)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        exit(1)
+
+    # Check that every shell is there before sending anything to any of them.
+    registry = read_registry()
+    missing = [
+        name
+        for name in steps
+        if name not in registry or shtuff_process_has_terminated(*registry[name])
+    ]
+    if missing:
+        for name in missing:
+            print_target_not_found(name)
+        exit(1)
+
+    if not steps:
         return
 
-    print("\n".join(receivers))
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(name):
+        try:
+            return run_batch(name, registry[name], steps[name], newline, timeout), None
+        except (TargetNotFoundError, ConnectionResetError, BrokenPipeError):
+            return None, f"Shtuff target {name} was not found."
+        except WaitUnsupportedError:
+            return None, f"Shtuff target {name} cannot be waited on."
+        except socket.timeout:
+            return None, f"Timed out waiting for {name}."
 
+    with ThreadPoolExecutor(max_workers=min(len(steps), 32)) as executor:
+        results = dict(zip(steps, executor.map(run, steps)))
 
-def get_unsafe_name(name):
-    return base64.urlsafe_b64decode(name.replace(".pid", "")).decode("utf8")
+    for name in sorted(results):
+        count, error = results[name]
+        if error is not None:
+            print(error, file=sys.stderr)
+        else:
+            print(f"Stuffed {count} command{'s' if count != 1 else ''} into {name}.")
 
+    if any(error is not None for count, error in results.values()):
+        exit(1)
 
-def get_pid_file(name):
-    safe_name = base64.urlsafe_b64encode(name.encode("utf8")).decode("utf8")
-    return data_dir(f"{safe_name}.pid")
 
+def parse_manifest(lines):
+    """
+    Parse a `shtuff batch` manifest into a dict mapping the name of every
+    shell in it to a list of steps for that shell, in order. A step is one
+    of:
 
-def get_pid_from_file(pid_file):
-    with open(pid_file) as f:
-        return int(f.read().strip())
+        ("send", command, quiet), where quiet is None, or how many seconds
+            the shell has to be quiet for the command to count as done
+        ("sleep", seconds)
 
+    Raises ValueError if the manifest doesn't make sense.
+    """
+    steps = {}
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip("\n")
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
 
-def get_cmd_file(pid):
-    return data_dir(f"{pid}.command")
+        name, *cmd = line.split(None, 1)
+        cmd = cmd[0].strip() if cmd else ""
+        target_steps = steps.setdefault(name, [])
+        directive, *args = cmd.split() or [""]
+        try:
+            if directive == "@wait":
+                if not target_steps or target_steps[-1][0] != "send":
+                    raise ValueError("@wait has to come after a command")
+                if len(args) > 1:
+                    raise ValueError("@wait takes at most one duration")
+                quiet = parse_duration(directive, args[0]) if args else DEFAULT_QUIET
+                target_steps[-1] = ("send", target_steps[-1][1], quiet)
+            elif directive == "@sleep":
+                if len(args) != 1:
+                    raise ValueError("@sleep requires a duration")
+                target_steps.append(("sleep", parse_duration(directive, args[0])))
+            else:
+                target_steps.append(("send", cmd, None))
+        except ValueError as e:
+            raise ValueError(f"line {lineno}: {e}") from e
 
+    return steps
 
-def get_process_command(pid):
-    return (
-        subprocess.run(
-            f"ps -p {pid} -o command",
-            capture_output=True,
-            shell=True,
-        )
-        .stdout.decode()
-        .split("\n")[-2]
-        .strip()
-    )
 
+def parse_duration(directive, arg):
+    """
+    Parse the duration given to a manifest directive, in seconds.
+    """
+    try:
+        return float(arg)
+    except ValueError as e:
+        raise ValueError(f"{directive} takes a duration in seconds, not {arg}") from e
 
-def find_nearest_shtuff_process():
-    def ppid(process):
-        parent = process.parent()
-        if parent is None or parent.pid == process.pid:
+
+def run_batch(name, receiver, steps, newline, timeout):
+    """
+    Run the given steps (see parse_manifest()) against the given receiver.
+    Returns how many commands were sent.
+    """
+    with Client(timeout=timeout) as client:
+        # We already looked everybody up, don't do it again for the rest of
+        # the batch.
+        client.receivers[name] = (receiver, float("inf"))
+
+        # Commands that don't need to be waited on go out together. They only
+        # need to be acknowledged if a later @wait has to start timing after
+        # they have been stuffed.
+        pending = []
+        ack = any(step[0] == "send" and step[2] is not None for step in steps)
+
+        def flush():
+            if pending:
+                client.send_batch(name, pending, newline, ack=ack)
+                pending.clear()
+
+        count = 0
+        for step in steps:
+            if step[0] == "sleep":
+                flush()
+                time.sleep(step[1])
+                continue
+
+            _, cmd, quiet = step
+            count += 1
+            if quiet is None:
+                pending.append(cmd)
+            else:
+                flush()
+                client.send(name, cmd, newline, wait=True, quiet=quiet)
+
+        flush()
+
+    return count
+
+
+def get_wait_options(ack=False, wait=False, quiet=None, prompt=None):
+    """
+    Turn `shtuff into`'s options for what to wait for into the wait argument
+    of stuff_into(). Raises re.error if prompt is not a valid regex.
+    """
+    if wait:
+        if quiet is None and prompt is None:
+            quiet = DEFAULT_QUIET
+        if prompt is not None:
+            import re
+
+            re.compile(prompt)
+        return {"quiet": quiet, "prompt": prompt}
+
+    if ack:
+        return {}
+
+    return None
+
+
+def get_priority_options(priority=False, interrupt=False, cancel=False):
+    """
+    Turn `shtuff into`'s options for jumping the line into the priority
+    argument of stuff_into(): None for an ordinary command, or a dict of
+    what to do about the commands ahead of it (see Relay.prioritize()).
+    Interrupting or cancelling implies priority.
+    """
+    if not (priority or interrupt or cancel):
+        return None
+
+    return {"interrupt": interrupt, "cancel": cancel}
+
+
+def try_stuff_into(receiver, target, data, wait=None, timeout=None, priority=None):
+    """
+    Like stuff_into(), but returns a (reply, error) tuple, where error is a
+    message for the user if delivery failed.
+    """
+    try:
+        reply = stuff_into(receiver, data, wait, timeout, priority)
+    except WaitUnsupportedError:
+        return None, f"Shtuff target {target} cannot be waited on."
+    except socket.timeout:
+        return None, f"Timed out waiting for {target}."
+
+    if reply is None:
+        return None, f"Shtuff target {target} was not found."
+
+    if reply.get("cancelled"):
+        return None, f"Shtuff target {target} cancelled the command."
+
+    return reply, None
+
+
+def stuff_into(receiver, data, wait=None, timeout=None, priority=None):
+    """
+    Deliver the given data (either bytes, or a binary file to stream from) to
+    the given receiver. Returns what the receiver told us about it (see
+    stuff_over_socket()), or None if the receiver is gone.
+    """
+    # Check before connecting: if the receiver's pid got reused by another
+    # receiver, its control socket belongs to somebody else now.
+    if shtuff_process_has_terminated(*receiver):
+        return None
+
+    pid = receiver.pid
+    try:
+        reply = stuff_over_socket(receiver, data, wait, timeout, priority)
+    except (BrokenPipeError, ConnectionResetError):
+        # The receiver went away while we were talking to it.
+        return None
+
+    if reply is not None:
+        return reply
+
+    if receiver.slot is not None:
+        # The supervisor has closed the slot since we checked on it.
+        return None
+
+    if wait is not None:
+        raise WaitUnsupportedError()
+
+    # The receiver is not listening on a control socket, so fall back to
+    # handing the command off through the filesystem and waking it up with
+    # SIGUSR1.
+    if not isinstance(data, bytes):
+        data = data.read()
+
+    with trace("spool", receiver=pid):
+        if not spool_command(pid, data, priority):
+            # The receiver doesn't have a spool either. It is an older version
+            # of shtuff that only knows about a single command file.
+            with open(get_cmd_file(pid), "wb") as f:
+                f.write(data)
+
+    try:
+        with trace("signal", receiver=pid):
+            os.kill(pid, signal.SIGUSR1)
+    except ProcessLookupError:
+        return None
+
+    return {}
+
+
+class WaitUnsupportedError(Exception):
+    """
+    The receiver has no control socket to tell us when it's done with our
+    command.
+    """
+
+
+class TargetNotFoundError(Exception):
+    """
+    There is no receiver by the given name.
+    """
+
+
+class Client:
+    """
+    Send commands to receivers from Python, without starting a process for
+    every command.
+
+    Name lookups are cached for `cache_ttl` seconds, and the connection to
+    each receiver is kept open and reused. Replies are read off that same
+    connection, so a Client should only be used from one thread at a time.
+
+        with shtuff.Client() as client:
+            client.send("shell-a", "git status")
+            client.send_batch("shell-b", ["cd /tmp", "ls"], ack=True)
+    """
+
+    def __init__(self, timeout=None, cache_ttl=1.0):
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        # name -> (Receiver, when we looked it up)
+        self.receivers = {}
+        # Receiver -> (socket, file to read its replies from)
+        self.channels = {}
+
+    def send(
+        self,
+        name,
+        cmd,
+        newline=True,
+        ack=False,
+        wait=False,
+        quiet=None,
+        prompt=None,
+        priority=False,
+        interrupt=False,
+        cancel=False,
+    ):
+        """
+        Stuff the given command (a str, or bytes to send as is) into the named
+        receiver. Takes the same options as `shtuff into`, and returns the
+        receiver's reply as a dict (see stuff_over_socket()).
+        """
+        wait = get_wait_options(ack, wait, quiet, prompt)
+        priority = get_priority_options(priority, interrupt, cancel)
+        return self._deliver(name, [self._encode(cmd, newline)], wait, priority)[0]
+
+    def send_batch(self, name, cmds, newline=True, ack=False):
+        """
+        Stuff each of the given commands into the named receiver, in order,
+        in a single write. Returns a list of replies, one per command.
+        """
+        wait = get_wait_options(ack)
+        return self._deliver(name, [self._encode(cmd, newline) for cmd in cmds], wait)
+
+    def has(self, name):
+        receiver = self._lookup(name)
+        return receiver is not None and not shtuff_process_has_terminated(*receiver)
+
+    def whoami(self):
+        """
+        Return the names of the receiver this process is running in, or None
+        if it isn't running in one.
+        """
+        receiver = find_nearest_receiver()
+        if receiver is None:
             return None
 
-        if get_process_command(parent.pid) == "shtuff":
-            return parent.pid
+        return get_names_for_receiver(receiver)
 
-        return ppid(parent)
+    def ls(self):
+        """
+        Return a {name: pid} dict of every live receiver.
+        """
+        return {name: receiver.pid for name, receiver in prune_registry().items()}
 
-    return ppid(psutil.Process())
+    def close(self):
+        for receiver in list(self.channels):
+            self._close_channel(receiver)
 
+    def __enter__(self):
+        return self
 
-def spawn_and_stuff(to_spawn, to_stuff=None, name=None):
-    setproctitle.setproctitle("shtuff")
+    def __exit__(self, *exc_info):
+        self.close()
 
-    p = pexpect.spawn(to_spawn)
+    def _encode(self, cmd, newline):
+        if isinstance(cmd, str):
+            if newline:
+                cmd += "\n"
+            cmd = cmd.encode("utf8")
 
-    def resize():
-        s = struct.pack("HHHH", 0, 0, 0, 0)
-        a = struct.unpack(
-            "hhhh", fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, s)
-        )
-        p.setwinsize(a[0], a[1])
+        return cmd
 
-    # Trap SIGWINCH and pass it down to our spawned process.
-    # http://pexpect.readthedocs.io/en/stable/api/pexpect.html#pexpect.spawn.interact
-    signal.signal(signal.SIGWINCH, lambda sig, data: resize())
-    resize()
+    def _lookup(self, name, refresh=False):
+        cached = self.receivers.get(name)
+        if (
+            cached is not None
+            and not refresh
+            and time.monotonic() - cached[1] < self.cache_ttl
+        ):
+            return cached[0]
 
-    shtuff_pid = os.getpid()
+        receiver = lookup_receiver(name)
+        self.receivers[name] = (receiver, time.monotonic())
+        return receiver
 
-    def read_and_stuff_command():
-        cmd_file = get_cmd_file(shtuff_pid)
+    def _deliver(self, name, datas, wait, priority=None):
+        # If the receiver we remember has gone away, the name may well belong
+        # to a new one by now, so look it up again and retry once.
+        for refresh in (False, True):
+            receiver = self._lookup(name, refresh)
+            if receiver is None:
+                break
 
-        try:
-            with open(cmd_file) as f:
-                p.send(f.read())
-        except FileNotFoundError:
-            print(
-                f"\nReceived SIGUSR1, tried to read commands from {cmd_file}, but could not open the file.\n",
-                file=sys.stderr,
-            )
+            if priority is not None:
+                # The receiver doesn't read anything more off a connection
+                # while it still has commands from it waiting their turn, so
+                # a command that's to jump the line can't go over a channel
+                # that may have a backlog of ours. Send it on its own.
+                replies = self._deliver_without_channel(receiver, datas, wait, priority)
+                if replies is not None:
+                    return replies
+                continue
 
-    signal.signal(signal.SIGUSR1, lambda sig, data: read_and_stuff_command())
+            channel = self.channels.get(receiver)
+            if channel is None:
+                # Check before connecting: if the receiver's pid got reused
+                # by another receiver, its control socket belongs to somebody
+                # else now.
+                if shtuff_process_has_terminated(*receiver):
+                    continue
 
-    if to_stuff:
-        p.send(to_stuff)
+                channel = self._connect(receiver)
+                if channel is None:
+                    return self._deliver_without_socket(
+                        receiver, name, datas, wait, priority
+                    )
 
-    if name:
-        write_shtuff_pid(name, shtuff_pid)
+            sock, rfile = channel
+            messages = [
+                message
+                for data in datas
+                for message in encode_stuff(data, wait, priority)
+            ]
+            try:
+                sock.sendall(b"".join(messages))
+                return [read_stuff_reply(rfile, wait) for _ in datas]
+            except (BrokenPipeError, ConnectionResetError, EOFError):
+                self._close_channel(receiver)
+            except socket.timeout:
+                # Replies may still be on their way, and would get mixed up
+                # with the replies to whatever we send next.
+                self._close_channel(receiver)
+                raise
 
-    p.interact()
+        raise TargetNotFoundError(name)
 
+    def _deliver_without_channel(self, receiver, datas, wait, priority):
+        replies = []
+        for data in datas:
+            reply = stuff_into(receiver, data, wait, self.timeout, priority)
+            if reply is None:
+                return None
+            replies.append(reply)
 
-def print_target_not_found(name):
-    print(f"Shtuff target {name} was not found.", file=sys.stderr)
+        return replies
+
+    def _deliver_without_socket(self, receiver, name, datas, wait, priority=None):
+        replies = []
+        for data in datas:
+            reply = stuff_into(receiver, data, wait, self.timeout, priority)
+            if reply is None:
+                raise TargetNotFoundError(name)
+            replies.append(reply)
+
+        return replies
+
+    def _connect(self, receiver):
+        """
+        Open a (socket, rfile) tuple to the given receiver's control socket,
+        to be reused for everything we send it. Returns None if it isn't
+        listening on one.
+        """
+        sock = connect_to_receiver(receiver.pid, receiver.slot)
+        if sock is None:
+            return None
+
+        sock.settimeout(self.timeout)
+        channel = self.channels[receiver] = (sock, sock.makefile("rb"))
+        return channel
+
+    def _close_channel(self, receiver):
+        sock, rfile = self.channels.pop(receiver)
+        rfile.close()
+        sock.close()
+
+
+class AsyncClient:
+    """
+    Like Client, but for asyncio: every method is a coroutine that talks to
+    receivers with non-blocking I/O, so one event loop can drive any number
+    of them. At most `concurrency` of them are talked to at once.
+
+        client = shtuff.AsyncClient()
+        await client.wait_ready("shell-a")
+        await asyncio.gather(
+            *(client.send(name, "make", wait=True) for name in names)
+        )
+
+    Looking a name up (asking the broker, or opening the registry, which may
+    have to wait for a lock) and checking that its receiver is alive can
+    block, so they happen on the default executor, off the event loop.
+    """
+
+    def __init__(self, concurrency=64, timeout=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        # Created on first use, so it belongs to the running event loop.
+        self._semaphore = None
+
+    async def send(
+        self,
+        name,
+        cmd,
+        newline=True,
+        ack=False,
+        wait=False,
+        quiet=None,
+        prompt=None,
+        priority=False,
+        interrupt=False,
+        cancel=False,
+    ):
+        """
+        Stuff the given command (a str, or bytes to send as is) into the named
+        receiver. Takes the same options as Client.send(), and returns the
+        receiver's reply.
+        """
+        import asyncio
+
+        wait = get_wait_options(ack, wait, quiet, prompt)
+        priority = get_priority_options(priority, interrupt, cancel)
+        if isinstance(cmd, str):
+            if newline:
+                cmd += "\n"
+            cmd = cmd.encode("utf8")
+
+        receiver = await self._lookup(name)
+        async with self._limit():
+            connection = await self._connect(receiver)
+            if connection is None:
+                # The receiver has no control socket, so hand the command off
+                # through the spool on a thread.
+                reply = await asyncio.get_running_loop().run_in_executor(
+                    None, stuff_into, receiver, cmd, wait, None, priority
+                )
+                if reply is None:
+                    raise TargetNotFoundError(name)
+                return reply
+
+            reader, writer = connection
+            try:
+                for message in encode_stuff(cmd, wait, priority):
+                    writer.write(message)
+                await writer.drain()
+
+                reply = StuffReply(wait)
+                if not reply.complete:
+                    messages = read_messages_async(reader)
+                    await asyncio.wait_for(
+                        self._read_reply(messages, reply), self.timeout
+                    )
+                return reply.result()
+            except (BrokenPipeError, ConnectionResetError, EOFError) as e:
+                raise TargetNotFoundError(name) from e
+            finally:
+                writer.close()
+
+    async def has(self, name):
+        return await self._find(name) is not None
+
+    async def wait_ready(self, name, timeout=None):
+        """
+        Wait until there's a live receiver by the given name that's accepting
+        commands. Raises asyncio.TimeoutError if there still isn't one after
+        `timeout` seconds.
+        """
+        import asyncio
+
+        async def wait():
+            # Start watching before we look, so we can't miss the receiver
+            # registering in between (see wait_for_receivers()). Receivers
+            # listen on their control socket before they register.
+            with DirectoryWatcher(data_dir()) as watcher:
+                while True:
+                    receiver = await self._find(name)
+                    if receiver is not None and os.path.exists(
+                        get_socket_file(receiver.pid, receiver.slot)
+                    ):
+                        return
+                    await watcher.wait_async()
+
+        await asyncio.wait_for(wait(), timeout)
+
+    async def follow(self, name, size=0):
+        """
+        Yield what the named receiver prints from now on (starting with the
+        last `size` bytes it already printed, or everything it remembers if
+        size is None), as bytes, until it exits.
+        """
+        receiver = await self._lookup(name)
+        async with self._limit():
+            connection = await self._connect(receiver)
+        if connection is None:
+            raise TargetNotFoundError(name)
+
+        reader, writer = connection
+        try:
+            writer.write(encode_message({"op": "tail", "size": size, "follow": True}))
+            await writer.drain()
+            async for header, body in read_messages_async(reader):
+                if body:
+                    yield body
+        finally:
+            writer.close()
+
+    async def _lookup(self, name):
+        receiver = await self._find(name)
+        if receiver is None:
+            raise TargetNotFoundError(name)
+
+        return receiver
+
+    async def _find(self, name):
+        """
+        Return the live receiver by the given name, or None if there isn't
+        one.
+        """
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            None, find_live_receiver, name
+        )
+
+    def _limit(self):
+        import asyncio
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        return self._semaphore
+
+    async def _connect(self, receiver):
+        """
+        Return a (reader, writer) tuple connected to the given receiver's
+        control socket, or None if it isn't listening on one.
+        """
+        import asyncio
+
+        try:
+            return await asyncio.open_unix_connection(
+                get_socket_file(receiver.pid, receiver.slot)
+            )
+        except OSError:
+            return None
+
+    async def _read_reply(self, messages, reply):
+        async for header, body in messages:
+            if reply.on_message(header):
+                break
+
+
+def shtuff_new(cmd, newline, supervised):
+    if newline:
+        cmd += "\n"
+
+    start_receiver(os.environ["SHELL"], to_stuff=cmd, supervised=supervised)
+
+
+def start_receiver(to_spawn, to_stuff=None, name=None, groups=(), supervised=False):
+    """
+    Turn this process into a receiver running to_spawn (see
+    spawn_and_stuff()). If we can, hand the work off to the supervisor (if
+    supervised) or to a zygote instead, and only stick around as their thin
+    client.
+    """
+    if supervised:
+        attach_to_supervisor(to_spawn, to_stuff, name, groups)
+    fork_from_zygote(to_spawn, to_stuff, name, groups)
+    spawn_and_stuff(to_spawn, to_stuff, name, groups)
+
+
+def find_live_receiver(name):
+    """
+    Return the receiver registered under the given name, or None if there
+    isn't one or it has exited.
+    """
+    receiver = lookup_receiver(name)
+    if receiver is None or shtuff_process_has_terminated(*receiver):
+        return None
+
+    return receiver
+
+
+def shtuff_has(name):
+    receiver = find_live_receiver(name)
+
+    if receiver is None:
+        print_target_not_found(name)
+        exit(1)
+
+    print(f"Shtuff process {name} was found with pid of {receiver.pid}.")
+
+
+def shtuff_wait(names, timeout):
+    missing = wait_for_receivers(names, timeout)
+
+    if missing:
+        for name in names:
+            if name in missing:
+                print_target_not_found(name)
+        exit(1)
+
+
+def wait_for_receivers(names, timeout=None):
+    """
+    Wait until there's a live receiver by each of the given names. Returns
+    the set of names there still isn't one for after `timeout` seconds
+    (which is empty unless we timed out).
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def is_alive(name):
+        receiver = lookup_receiver(name)
+        return receiver is not None and not shtuff_process_has_terminated(*receiver)
+
+    # Start watching before we look, so we can't miss a receiver registering
+    # in between.
+    with DirectoryWatcher(data_dir()) as watcher:
+        missing = set(names)
+        while True:
+            missing = {name for name in missing if not is_alive(name)}
+            if not missing:
+                return missing
+
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return missing
+
+            watcher.wait(remaining)
+
+
+class DirectoryWatcher:
+    """
+    Lets you wait for a directory to be touched, as the data directory is
+    whenever a receiver registers. (The registry's own files won't do: the
+    last thing to change when a write is committed is the shared memory
+    index, and writing to a mapping doesn't make for inotify events.) This
+    uses inotify where there is one, and polls otherwise.
+    """
+
+    POLL_INTERVAL = 0.05
+    # From <sys/inotify.h>.
+    IN_ATTRIB = 0x004
+
+    def __init__(self, path):
+        # The inotify instance, or None if we have to poll.
+        self.fd = None
+        try:
+            import ctypes
+
+            libc = ctypes.CDLL(None, use_errno=True)
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            # Not Linux.
+            return
+
+        fd = inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return
+
+        if inotify_add_watch(fd, os.fsencode(path), self.IN_ATTRIB) < 0:
+            os.close(fd)
+            return
+
+        self.fd = fd
+
+    def wait(self, timeout=None):
+        """
+        Return once the directory has been touched, or after at most
+        `timeout` seconds. Without inotify, this returns after
+        POLL_INTERVAL seconds at most, whether anything changed or not.
+        """
+        if self.fd is None:
+            time.sleep(
+                self.POLL_INTERVAL
+                if timeout is None
+                else min(timeout, self.POLL_INTERVAL)
+            )
+            return
+
+        import select
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            if not select.select([self.fd], [], [], remaining)[0] or self.drain():
+                return
+
+    async def wait_async(self, timeout=None):
+        """
+        Like wait(), but as a coroutine that waits on the event loop.
+        """
+        import asyncio
+
+        if self.fd is None:
+            await asyncio.sleep(
+                self.POLL_INTERVAL
+                if timeout is None
+                else min(timeout, self.POLL_INTERVAL)
+            )
+            return
+
+        readable = asyncio.Event()
+
+        async def touched():
+            while True:
+                await readable.wait()
+                readable.clear()
+                if self.drain():
+                    return
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.fd, readable.set)
+        try:
+            await asyncio.wait_for(touched(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(self.fd)
+
+    def drain(self):
+        """
+        Take all the events off the queue (one look covers however many
+        times the directory was touched), and return whether any of them
+        were for the directory itself, rather than a file in it.
+        """
+        # struct inotify_event: the watch, the mask, a cookie and the length
+        # of the name that follows, which is empty for the directory itself.
+        event = struct.Struct("iIII")
+        touched = False
+        try:
+            while True:
+                events = os.read(self.fd, 64 * 1024)
+                if not events:
+                    break
+
+                offset = 0
+                while offset < len(events):
+                    name_length = event.unpack_from(events, offset)[3]
+                    touched = touched or name_length == 0
+                    offset += event.size + name_length
+        except BlockingIOError:
+            pass
+
+        return touched
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def shtuff_whoami():
+    receiver = find_nearest_receiver()
+
+    if receiver is None:
+        print(
+            "Error: this is not a shtuff shell. Use 'shtuff new' or 'shtuff as' to make one.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+    receivers = get_names_for_receiver(receiver)
+
+    if len(receivers) == 0:
+        print(
+            "Warning: this shtuff has no name. Use 'shtuff as' to give it a name.",
+            file=sys.stderr,
+        )
+        return
+
+    print("\n".join(receivers))
+
+
+def shtuff_ls():
+    for name, receiver in sorted(prune_registry().items()):
+        print(f"{name}\t{receiver.pid}")
+
+
+def connect_to_target(name):
+    """
+    Connect to the control socket of the receiver with the given name, or
+    exit if there isn't one.
+    """
+    receiver = lookup_receiver(name)
+    sock = None
+    if receiver is not None and not shtuff_process_has_terminated(*receiver):
+        sock = connect_to_receiver(receiver.pid, receiver.slot)
+
+    if sock is None:
+        print_target_not_found(name)
+        exit(1)
+
+    return sock
+
+
+def shtuff_tail(name, size, follow):
+    sock = connect_to_target(name)
+    with sock, sock.makefile("rb") as rfile:
+        send_message(sock, {"op": "tail", "size": size, "follow": follow})
+        try:
+            for header, body in read_messages(rfile):
+                sys.stdout.buffer.write(body)
+                sys.stdout.buffer.flush()
+                if not follow:
+                    break
+        except KeyboardInterrupt:
+            pass
+
+
+def shtuff_attach(name):
+    sock = connect_to_target(name)
+    old_tty_attrs = None
+    if os.isatty(sys.stdin.fileno()):
+        # Keep whatever gets typed off the screen: nothing typed here goes to
+        # the shell. Ctrl-C still works, and detaches.
+        old_tty_attrs = termios.tcgetattr(sys.stdin.fileno())
+        attrs = termios.tcgetattr(sys.stdin.fileno())
+        attrs[3] &= ~(termios.ECHO | termios.ICANON)
+        termios.tcsetattr(sys.stdin.fileno(), termios.TCSANOW, attrs)
+
+    try:
+        with sock, sock.makefile("rb") as rfile:
+            send_message(sock, {"op": "attach"})
+            for header, body in read_messages(rfile):
+                if header["op"] == "skipped":
+                    body = f"\r\n[shtuff: skipped {header['size']} bytes]\r\n"
+                    body = body.encode("utf8")
+                sys.stdout.buffer.write(body)
+                sys.stdout.buffer.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if old_tty_attrs is not None:
+            termios.tcsetattr(sys.stdin.fileno(), termios.TCSANOW, old_tty_attrs)
+
+
+def shtuff_stats(name, as_json):
+    if name is None:
+        candidates = read_registry()
+    else:
+        receiver = lookup_receiver(name)
+        candidates = {} if receiver is None else {name: receiver}
+
+    targets = get_live_targets(candidates)
+    if name is not None and not targets:
+        print_target_not_found(name)
+        exit(1)
+
+    rows = []
+    for receiver, target in targets.items():
+        stats = get_receiver_stats(receiver)
+        if stats is None:
+            print(f"Shtuff target {target} has no stats.", file=sys.stderr)
+            continue
+
+        rows.append((target, receiver, stats))
+
+    if not as_json and rows:
+        print("NAME\tPID\tUPTIME\tCOMMANDS\tSTUFFED\tOUTPUT\tFAILED\tP50\tP99")
+
+    for target, receiver, stats in sorted(rows, key=lambda row: row[0]):
+        if as_json:
+            print(json.dumps({"name": target, "pid": receiver.pid, **stats}))
+            continue
+
+        fields = [
+            target,
+            receiver.pid,
+            f"{stats['uptime']:.0f}s",
+            stats["commands"],
+            stats["bytes_stuffed"],
+            stats["bytes_output"],
+            stats["failed_deliveries"],
+            latency_percentile(stats, 50),
+            latency_percentile(stats, 99),
+        ]
+        print("\t".join(str(field) for field in fields))
+
+    if name is not None and not rows:
+        exit(1)
+
+
+def shtuff_broker():
+    exit_if_running("broker", ask_broker({"op": "ping"}) is not None)
+    broker = Broker()
+
+    def serve(server):
+        # We're listening before we load the registry, so receivers that
+        # register while we load it tell us about it once we get to them,
+        # rather than not at all.
+        broker.load()
+        broker.run(server)
+
+    serve_unix_socket(get_broker_socket_file(), serve)
+
+
+def exit_if_running(daemon, running):
+    if running:
+        print(f"Error: a shtuff {daemon} is already running.", file=sys.stderr)
+        exit(1)
+
+
+def serve_unix_socket(socket_file, serve):
+    """
+    Listen on a unix socket at the given path, and hand it to serve(), which
+    accepts connections until we get killed. For the per-user daemons, once
+    they've checked that there isn't one running already.
+    """
+    if os.path.exists(socket_file):
+        # A leftover from one that died.
+        os.unlink(socket_file)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_file)
+    server.listen()
+    # Clean up on the way out when we get killed, too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(server)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(socket_file)
+
+
+def connect_unix(socket_file):
+    """
+    Connect to the unix socket at the given path. Returns None if nobody is
+    listening on it.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_file)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+
+    return sock
+
+
+def is_listening(socket_file):
+    sock = connect_unix(socket_file)
+    if sock is None:
+        return False
+
+    sock.close()
+    return True
+
+
+def get_supervisor_socket_file():
+    return data_dir("supervisor.sock")
+
+
+def is_supervisor(pid):
+    """
+    Return whether the given pid is a supervisor, going by whether it has
+    any slots listening on control sockets (see get_socket_file()).
+    """
+    prefix = f"{pid}-"
+    return any(
+        file.startswith(prefix) and file.endswith(".sock")
+        for file in os.listdir(data_dir())
+    )
+
+
+# How long the supervisor waits on the other end of a connection before
+# giving up on it.
+SUPERVISOR_TIMEOUT = 1
+
+
+# What the terminal of a supervised receiver runs once it has handed its
+# stdin and stdout over to the supervisor (see attach_to_supervisor()). It
+# runs in a bare interpreter to keep it small, so it only imports what it
+# has to.
+THIN_CLIENT = """\
+import os, sys, json, signal
+
+fd = int(sys.argv[1])
+
+def resize(signum, frame):
+    os.write(fd, json.dumps({"op": "resize", "length": 0}).encode() + b"\\n")
+
+signal.signal(signal.SIGWINCH, resize)
+
+buf = b""
+while True:
+    data = os.read(fd, 4096)
+    if not data:
+        # The supervisor died, and may have left the terminal in raw mode.
+        os.system("stty sane")
+        sys.exit(1)
+    buf += data
+    while b"\\n" in buf:
+        line, buf = buf.split(b"\\n", 1)
+        header = json.loads(line)
+        if header["op"] == "exit":
+            sys.exit(header["status"])
+"""
+
+
+def attach_to_supervisor(to_spawn, to_stuff=None, name=None, groups=()):
+    """
+    Have the running `shtuff supervisor` spawn a receiver on our terminal,
+    and turn this process into its thin client. Only returns if there is no
+    supervisor running.
+    """
+    sock = connect_unix(get_supervisor_socket_file())
+    if sock is None:
+        print(
+            "Warning: no shtuff supervisor is running, starting a standalone receiver.",
+            file=sys.stderr,
+        )
+        return
+
+    hand_off_terminal(sock, to_spawn, to_stuff, name, groups)
+
+
+def hand_off_terminal(sock, to_spawn, to_stuff, name, groups):
+    """
+    Ask whoever is on the other end of sock (a supervisor or a zygote) to
+    spawn a receiver on our terminal, and turn this process into its thin
+    client.
+    """
+    request = {
+        "op": "spawn",
+        "cmd": to_spawn,
+        "stuff": to_stuff,
+        "name": name,
+        "groups": list(groups),
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        **get_process_limits(),
+    }
+    fds = [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()]
+    send_with_fds(sock, encode_message(request), fds)
+
+    sock.set_inheritable(True)
+    os.execv(
+        sys.executable,
+        [sys.executable, "-I", "-S", "-c", THIN_CLIENT, str(sock.fileno())],
+    )
+
+
+# The resource limits a receiver spawned for us by a supervisor or a zygote
+# gets from us, as it would if we had spawned it ourselves.
+INHERITED_RLIMITS = [
+    "RLIMIT_AS",
+    "RLIMIT_CORE",
+    "RLIMIT_CPU",
+    "RLIMIT_DATA",
+    "RLIMIT_FSIZE",
+    "RLIMIT_MEMLOCK",
+    "RLIMIT_NOFILE",
+    "RLIMIT_NPROC",
+    "RLIMIT_STACK",
+]
+
+
+def get_process_limits():
+    """
+    Return our umask and resource limits, for set_process_limits() to give
+    to a process that isn't our child.
+    """
+    import resource
+
+    # There's no way to read the umask without setting it.
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return {
+        "umask": umask,
+        "rlimits": {
+            name: resource.getrlimit(getattr(resource, name))
+            for name in INHERITED_RLIMITS
+            if hasattr(resource, name)
+        },
+    }
+
+
+def set_process_limits(request):
+    """
+    Take on the umask and resource limits in the given spawn request (see
+    get_process_limits()), as far as we're allowed to.
+    """
+    import resource
+
+    if request.get("umask") is not None:
+        os.umask(request["umask"])
+
+    for name, limits in request.get("rlimits", {}).items():
+        try:
+            resource.setrlimit(getattr(resource, name), tuple(limits))
+        except (AttributeError, ValueError, OSError):
+            # Only root can raise a hard limit.
+            pass
+
+
+def read_thin_client_messages(sock, rbuf):
+    """
+    Read whatever a thin client has sent over sock into the bytearray rbuf,
+    and return the headers of the messages that completed, or None if the
+    thin client has hung up.
+    """
+    try:
+        data = sock.recv(4096)
+    except BlockingIOError:
+        return []
+    except OSError:
+        data = b""
+
+    if not data:
+        return None
+
+    rbuf += data
+    headers = []
+    try:
+        message = parse_message(rbuf)
+        while message is not None:
+            headers.append(message[0])
+            message = parse_message(rbuf)
+    except (ValueError, KeyError):
+        rbuf.clear()
+
+    return headers
+
+
+def read_spawn_request(sock):
+    """
+    Read the request hand_off_terminal() sends. Returns a (request, fds)
+    tuple, where fds are the thin client's stdin, stdout and stderr, or None
+    (after closing sock) if the request didn't arrive in one piece.
+    """
+    sock.settimeout(SUPERVISOR_TIMEOUT)
+    fds = []
+    try:
+        buf = bytearray()
+        request = None
+        while request is None:
+            data, new_fds = recv_with_fds(sock, 64 * 1024, 3)
+            fds += new_fds
+            if not data:
+                raise EOFError("connection closed in the middle of a request")
+            buf += data
+            request = parse_spawn_request(buf, fds)
+    except (OSError, EOFError, ValueError, KeyError):
+        sock.close()
+        for fd in fds:
+            os.close(fd)
+        return None
+
+    return request, fds
+
+
+def parse_spawn_request(buf, fds):
+    """
+    If the bytearray buf holds all of the request hand_off_terminal() sends
+    (and fds the fds that came with it so far), return the request, or None
+    if there's more to come. Raises ValueError (or KeyError) if it isn't a
+    spawn request.
+    """
+    message = parse_message(buf)
+    if message is None:
+        return None
+
+    request, body = message
+    if request["op"] != "spawn" or len(fds) != 3:
+        raise ValueError("expected a spawn request with 3 fds")
+
+    return request
+
+
+def send_exit_status(sock, process):
+    """
+    Tell a thin client how the given (pexpect) child exited, so it can exit
+    the same way.
+    """
+    status = process.exitstatus
+    if status is None:
+        status = 128 + process.signalstatus
+
+    sock.settimeout(SUPERVISOR_TIMEOUT)
+    try:
+        send_message(sock, {"op": "exit", "status": status})
+    except OSError:
+        pass
+
+
+def detach_from_terminal():
+    """
+    Give up our controlling terminal, if we have one. Daemons read and write
+    the terminals of thin clients, and if one of those happens to be theirs,
+    the kernel would treat them as a background job using it, and stop them.
+    """
+    try:
+        fd = os.open("/dev/tty", os.O_RDWR | os.O_NOCTTY)
+    except OSError:
+        return
+
+    try:
+        fcntl.ioctl(fd, termios.TIOCNOTTY)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def shtuff_supervisor():
+    import setproctitle
+
+    exit_if_running("supervisor", is_listening(get_supervisor_socket_file()))
+
+    # Our children look for a process called shtuff to find their receiver.
+    setproctitle.setproctitle("shtuff")
+    detach_from_terminal()
+    supervisor = Supervisor()
+
+    # Senders that don't know about slots fall back to waking up a receiver
+    # with SIGUSR1, which would otherwise kill every shell we host.
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    def serve(server):
+        try:
+            supervisor.run(server)
+        finally:
+            supervisor.close()
+
+    serve_unix_socket(get_supervisor_socket_file(), serve)
+
+
+def get_zygote_socket_file():
+    return data_dir("zygote.sock")
+
+
+def fork_from_zygote(to_spawn, to_stuff=None, name=None, groups=()):
+    """
+    Have the running `shtuff zygote` fork a receiver for our terminal, and
+    turn this process into its thin client. Only returns if there is no
+    zygote running.
+    """
+    sock = connect_unix(get_zygote_socket_file())
+    if sock is None:
+        return
+
+    hand_off_terminal(sock, to_spawn, to_stuff, name, groups)
+
+
+def shtuff_zygote():
+    import setproctitle
+
+    exit_if_running("zygote", is_listening(get_zygote_socket_file()))
+
+    setproctitle.setproctitle("shtuff-zygote")
+    detach_from_terminal()
+    zygote = Zygote()
+    zygote.warm_up()
+
+    # The receivers we fork are on their own once they're running, so don't
+    # leave zombies around when they exit.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    serve_unix_socket(get_zygote_socket_file(), zygote.run)
+
+
+def get_receiver_stats(receiver, timeout=5):
+    """
+    Ask the given receiver for its Stats. Returns None if it isn't listening
+    on a control socket.
+    """
+    sock = connect_to_receiver(receiver.pid, receiver.slot)
+    if sock is None:
+        return None
+
+    with sock, sock.makefile("rb") as rfile:
+        sock.settimeout(timeout)
+        send_message(sock, {"op": "stats"})
+        try:
+            for header, body in read_messages(rfile):
+                return json.loads(body)
+        except (OSError, EOFError):
+            pass
+
+    return None
+
+
+def latency_percentile(stats, percentile):
+    """
+    Estimate the given percentile of delivery latency from the histogram in
+    the given stats, as a human readable upper bound.
+    """
+    histogram = stats["latency_histogram"]
+    buckets = stats["latency_buckets"]
+    total = sum(histogram)
+    if total == 0:
+        return "-"
+
+    seen = 0
+    for bucket, count in enumerate(histogram):
+        seen += count
+        if seen >= total * percentile / 100:
+            break
+
+    def format_seconds(seconds):
+        return f"{seconds * 1000:g}ms" if seconds < 1 else f"{seconds:g}s"
+
+    if bucket == len(buckets):
+        return f">{format_seconds(buckets[-1])}"
+
+    return f"<={format_seconds(buckets[bucket])}"
+
+
+def get_unsafe_name(name):
+    return base64.urlsafe_b64decode(name.replace(".pid", "")).decode("utf8")
+
+
+def get_pid_from_file(pid_file):
+    with open(pid_file) as f:
+        return int(f.read().strip())
+
+
+# Each entry migrates the registry from the previous version (the index of
+# the entry) to the next one. The version is tracked in sqlite's user_version.
+REGISTRY_MIGRATIONS = [
+    """
+    CREATE TABLE receivers (name TEXT PRIMARY KEY, pid INTEGER NOT NULL);
+    CREATE INDEX receivers_by_pid ON receivers (pid);
+    CREATE TABLE groups (
+        grp TEXT NOT NULL,
+        name TEXT NOT NULL,
+        PRIMARY KEY (grp, name)
+    );
+    """,
+    """
+    ALTER TABLE receivers ADD COLUMN start_time INTEGER;
+    """,
+    """
+    ALTER TABLE receivers ADD COLUMN slot INTEGER;
+    """,
+    """
+    CREATE TABLE deferred (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        data BLOB NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE INDEX deferred_by_name ON deferred (name, id);
+    """,
+]
+
+_registry_connections = threading.local()
+
+
+def open_registry():
+    """
+    Return this thread's connection to the registry, creating and migrating
+    the registry if necessary.
+    """
+    registry = getattr(_registry_connections, "registry", None)
+    if registry is not None:
+        return registry
+
+    with trace("open_registry"):
+        import sqlite3
+
+        # We manage transactions ourselves, see registry_transaction().
+        registry = sqlite3.connect(
+            data_dir("registry.sqlite3"), timeout=30, isolation_level=None
+        )
+        # Write-ahead logging lets readers carry on while someone registers.
+        registry.execute("PRAGMA journal_mode = WAL")
+        registry.execute("PRAGMA synchronous = NORMAL")
+        _registry_connections.registry = registry
+
+        (user_version,) = registry.execute("PRAGMA user_version").fetchone()
+        if user_version < len(REGISTRY_MIGRATIONS):
+            with registry_transaction() as registry:
+                # Somebody else may have migrated while we waited for the lock.
+                (user_version,) = registry.execute("PRAGMA user_version").fetchone()
+                for migration in REGISTRY_MIGRATIONS[user_version:]:
+                    for statement in migration.split(";"):
+                        registry.execute(statement)
+
+                if user_version == 0:
+                    import_legacy_registry(registry)
+
+                registry.execute(f"PRAGMA user_version = {len(REGISTRY_MIGRATIONS)}")
+
+    return registry
+
+
+@contextmanager
+def registry_transaction():
+    """
+    Run the body in a write transaction. Concurrent writers queue up behind
+    each other rather than failing.
+    """
+    registry = open_registry()
+    registry.execute("BEGIN IMMEDIATE")
+    try:
+        yield registry
+    except BaseException:
+        registry.execute("ROLLBACK")
+        raise
+
+    registry.execute("COMMIT")
+
+
+def import_legacy_registry(registry):
+    """
+    Move names registered by older versions of shtuff (one base64 encoded
+    `.pid` file per name) into the registry.
+    """
+    for pid_file in os.listdir(data_dir()):
+        if os.path.splitext(pid_file)[1] != ".pid":
+            continue
+
+        try:
+            name = get_unsafe_name(pid_file)
+            pid = get_pid_from_file(data_dir(pid_file))
+        except (ValueError, OSError):
+            # Older versions could leave a half written (or empty) file
+            # behind. Whoever it was for is long gone.
+            pass
+        else:
+            registry.execute(
+                "INSERT OR REPLACE INTO receivers (name, pid) VALUES (?, ?)",
+                (name, pid),
+            )
+
+        try:
+            os.unlink(data_dir(pid_file))
+        except FileNotFoundError:
+            pass
+
+
+def lookup_receiver(name):
+    with trace("lookup_receiver"):
+        reply = ask_broker({"op": "lookup", "name": name})
+        if reply is not None and reply["receiver"] is not None:
+            return Receiver(*reply["receiver"])
+
+        # The broker may not have heard about the name yet (or have missed
+        # it), but the registry is the source of truth.
+        row = (
+            open_registry()
+            .execute(
+                "SELECT pid, start_time, slot FROM receivers WHERE name = ?", (name,)
+            )
+            .fetchone()
+        )
+        return None if row is None else Receiver(*row)
+
+
+def get_live_targets(candidates):
+    """
+    Given a {name: receiver} dict, return a {receiver: target} dict of the
+    receivers in it that are still alive, where target lists every name the
+    receiver was given under.
+    """
+    names_by_receiver = {}
+    for name, receiver in candidates.items():
+        if not shtuff_process_has_terminated(*receiver):
+            names_by_receiver.setdefault(receiver, []).append(name)
+
+    return {
+        receiver: ", ".join(sorted(names))
+        for receiver, names in names_by_receiver.items()
+    }
+
+
+def get_names_for_receiver(receiver):
+    reply = ask_broker({"op": "names", "receiver": receiver})
+    if reply is not None:
+        return reply["names"]
+
+    return [
+        name
+        for (name,) in open_registry().execute(
+            "SELECT name FROM receivers"
+            " WHERE pid = ? AND (start_time IS NULL OR start_time = ?) AND slot IS ?"
+            " ORDER BY name",
+            receiver,
+        )
+    ]
+
+
+def read_registry(use_broker=True):
+    """
+    Return a dict mapping every registered name to its receiver. Unless
+    use_broker is False (for the broker itself), ask the broker if there is
+    one.
+    """
+    reply = ask_broker({"op": "ls"}) if use_broker else None
+    if reply is not None:
+        return parse_broker_receivers(reply)
+
+    return {
+        name: Receiver(pid, start_time, slot)
+        for name, pid, start_time, slot in open_registry().execute(
+            "SELECT name, pid, start_time, slot FROM receivers"
+        )
+    }
+
+
+def get_group_members(group):
+    """
+    Return a dict mapping the name of every member of the given group to its
+    receiver.
+    """
+    reply = ask_broker({"op": "group", "group": group})
+    if reply is not None:
+        return parse_broker_receivers(reply)
+
+    return {
+        name: Receiver(pid, start_time, slot)
+        for name, pid, start_time, slot in open_registry().execute(
+            "SELECT receivers.name, pid, start_time, slot FROM groups"
+            " JOIN receivers ON receivers.name = groups.name"
+            " WHERE grp = ?",
+            (group,),
+        )
+    }
+
+
+def prune_registry(use_broker=True):
+    """
+    Forget every registered name whose receiver is no longer running, and
+    clean up any files dead receivers left behind. Returns a dict mapping the
+    name of every live receiver to it. See read_registry() for use_broker.
+    """
+    registry = read_registry(use_broker)
+    # Many names may share a receiver, only check each one once.
+    alive = {
+        receiver: not shtuff_process_has_terminated(*receiver)
+        for receiver in set(registry.values())
+    }
+
+    dead = [
+        (name, *receiver) for name, receiver in registry.items() if not alive[receiver]
+    ]
+    if dead:
+        with registry_transaction() as transaction:
+            # Only delete names that haven't been re-registered in the meantime.
+            transaction.executemany(
+                "DELETE FROM receivers"
+                " WHERE name = ? AND pid = ? AND start_time IS ? AND slot IS ?",
+                dead,
+            )
+            transaction.execute(
+                "DELETE FROM groups WHERE name NOT IN (SELECT name FROM receivers)"
+            )
+
+    for entry in os.listdir(data_dir()):
+        pid, ext = os.path.splitext(entry)
+        # The control sockets of a supervisor's slots are named <pid>-<slot>.
+        pid = pid.split("-")[0]
+        if ext not in (".sock", ".spool", ".command") or not pid.isdigit():
+            continue
+
+        if shtuff_process_has_terminated(int(pid)):
+            path = data_dir(entry)
+            if os.path.isdir(path):
+                import shutil
+
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+    return {name: receiver for name, receiver in registry.items() if alive[receiver]}
+
+
+def forget_receiver(receiver):
+    """
+    Remove every name registered to the given receiver, which has exited.
+    """
+    with registry_transaction() as transaction:
+        transaction.execute(
+            "DELETE FROM receivers WHERE pid = ? AND start_time IS ? AND slot IS ?",
+            receiver,
+        )
+        transaction.execute(
+            "DELETE FROM groups WHERE name NOT IN (SELECT name FROM receivers)"
+        )
+
+
+def get_broker_socket_file():
+    return data_dir("broker.sock")
+
+
+# How long to wait for the broker before giving up on it and going to the
+# registry ourselves.
+BROKER_TIMEOUT = 1
+
+
+def ask_broker(request):
+    """
+    Send a request to the broker (see shtuff_broker()) and return its reply,
+    or None if there's no broker running.
+    """
+    with trace("ask_broker", op=request["op"]) as span:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(BROKER_TIMEOUT)
+            sock.connect(get_broker_socket_file())
+            send_message(sock, request)
+            with sock.makefile("rb") as rfile:
+                for reply, body in read_messages(rfile):
+                    return reply
+        except (OSError, EOFError, ValueError) as e:
+            span.note(error=type(e).__name__)
+        finally:
+            sock.close()
+
+    return None
+
+
+def parse_broker_receivers(reply):
+    return {name: Receiver(*receiver) for name, receiver in reply["receivers"].items()}
+
+
+def get_cmd_file(pid):
+    return data_dir(f"{pid}.command")
+
+
+def get_spool_dir(pid):
+    return data_dir(f"{pid}.spool")
+
+
+_spool_sequence = itertools.count()
+
+
+def spool_command(pid, data, priority=None):
+    """
+    Publish a command into the spool of the receiver with the given pid.
+    Returns False if the receiver has no spool. See get_priority_options()
+    for priority.
+
+    Each command gets its own entry, which is written under a hidden name and
+    then renamed into place, so the receiver never sees a partially written
+    command and concurrent senders never clobber each other. Entry names sort
+    in the order they were published, priority ones first.
+    """
+    spool_dir = get_spool_dir(pid)
+    if not os.path.isdir(spool_dir):
+        return False
+
+    import tempfile
+
+    fd, tmp_path = tempfile.mkstemp(dir=spool_dir, prefix=".")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+
+    entry = f"{time.time_ns():020d}-{os.getpid()}-{next(_spool_sequence):06d}"
+    if priority is not None:
+        # "+" sorts before any digit (and older receivers still parse the
+        # timestamp, they just don't give it priority).
+        flags = "".join(flag[0] for flag in ("interrupt", "cancel") if priority[flag])
+        entry = f"+{entry}-{flags}"
+    os.rename(tmp_path, os.path.join(spool_dir, entry))
+    return True
+
+
+def drain_spool(pid):
+    """
+    Yield (and remove) every command published into the spool of the
+    receiver with the given pid, in the order they were published (priority
+    ones first), as (data, sent_at, priority) tuples, where sent_at is when it
+    was published by time.monotonic(), and priority is as passed to
+    spool_command().
+    """
+    # Entry names record when they were published by the wall clock.
+    monotonic_offset = time.monotonic() - time.time()
+    spool_dir = get_spool_dir(pid)
+    for entry in sorted(os.listdir(spool_dir)):
+        if entry.startswith("."):
+            # Still being written.
+            continue
+
+        path = os.path.join(spool_dir, entry)
+        with open(path, "rb") as f:
+            data = f.read()
+        os.unlink(path)
+
+        published_at, _, _, *flags = entry.split("-")
+        priority = None
+        if entry.startswith("+"):
+            priority = get_priority_options(
+                priority=True, interrupt="i" in flags[0], cancel="c" in flags[0]
+            )
+        yield data, int(published_at) / 1e9 + monotonic_offset, priority
+
+
+def get_socket_file(pid, slot=None):
+    if slot is not None:
+        return data_dir(f"{pid}-{slot}.sock")
+
+    return data_dir(f"{pid}.sock")
+
+
+def connect_to_receiver(pid, slot=None):
+    """
+    Connect to the control socket of the receiver with the given pid (and
+    slot). Returns None if the receiver is not listening on one.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(get_socket_file(pid, slot))
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+
+def send_message(sock, header, body=b""):
+    """
+    Send a single message over a control socket. A message is a line of JSON
+    describing it, followed by `length` bytes of body.
+    """
+    sock.sendall(encode_message(header, body))
+
+
+def read_messages(rfile):
+    """
+    Yield (header, body) tuples for every message read from the given file
+    object until EOF.
+    """
+    for line in rfile:
+        header = json.loads(line)
+        body = rfile.read(header["length"])
+        if len(body) != header["length"]:
+            raise EOFError("control socket closed in the middle of a message")
+
+        yield header, body
+
+
+async def read_messages_async(reader):
+    """
+    Like read_messages(), but reads from an asyncio.StreamReader.
+    """
+    import asyncio
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+
+        header = json.loads(line)
+        try:
+            body = await reader.readexactly(header["length"])
+        except asyncio.IncompleteReadError as e:
+            raise EOFError("control socket closed in the middle of a message") from e
+
+        yield header, body
+
+
+def send_with_fds(sock, data, fds):
+    """
+    Send the given bytes over a Unix socket, along with the given file
+    descriptors.
+    """
+    import array
+
+    sent = sock.sendmsg(
+        [data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+    )
+    sock.sendall(data[sent:])
+
+
+def recv_with_fds(sock, size, max_fds):
+    """
+    Receive up to size bytes from a Unix socket, and any file descriptors
+    that came along with them (up to max_fds). Returns a (data, fds) tuple.
+    """
+    import array
+
+    fds = array.array("i")
+    data, ancdata, flags, addr = sock.recvmsg(
+        size, socket.CMSG_SPACE(max_fds * fds.itemsize)
+    )
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[: len(cdata) - len(cdata) % fds.itemsize])
+
+    return data, list(fds)
+
+
+def encode_message(header, body=b""):
+    header = dict(header, length=len(body))
+    return json.dumps(header).encode("utf8") + b"\n" + body
+
+
+def parse_message(buf):
+    """
+    If the given bytearray starts with a complete message, remove it and
+    return it as a (header, body) tuple. Otherwise, return None.
+    """
+    end_of_header = buf.find(b"\n")
+    if end_of_header == -1:
+        return None
+
+    header = json.loads(buf[:end_of_header])
+    end_of_body = end_of_header + 1 + header["length"]
+    if len(buf) < end_of_body:
+        return None
+
+    body = bytes(buf[end_of_header + 1 : end_of_body])
+    del buf[:end_of_body]
+    return header, body
+
+
+# How much data goes into a single "stuff" message. The receiver handles one
+# message at a time, so this bounds how much of a large payload it holds in
+# memory at once.
+STUFF_CHUNK_SIZE = 64 * 1024
+
+
+def iter_chunks(data):
+    """
+    Yield (chunk, more) tuples for the given data (either bytes, or a binary
+    file to stream from), where chunk is at most STUFF_CHUNK_SIZE bytes and
+    more is False for the final chunk.
+    """
+    if isinstance(data, bytes):
+        # An empty command (just an interrupt, say) still takes a message.
+        for start in range(0, max(len(data), 1), STUFF_CHUNK_SIZE):
+            yield (
+                data[start : start + STUFF_CHUNK_SIZE],
+                start + STUFF_CHUNK_SIZE < len(data),
+            )
+
+        return
+
+    while True:
+        # read1() returns whatever is available, so we don't sit on input
+        # that's trickling in. That means we can't know which chunk is the
+        # last one until we hit EOF, so finish with an empty one.
+        chunk = data.read1(STUFF_CHUNK_SIZE)
+        yield chunk, bool(chunk)
+        if not chunk:
+            return
+
+
+def stuff_over_socket(receiver, data, wait=None, timeout=None, priority=None):
+    """
+    Try to deliver the given data (either bytes, or a binary file to stream
+    from) to the given receiver over its control socket. Returns None if the
+    receiver is not listening on one. See get_priority_options() for
+    priority.
+
+    Once the receiver's socket buffer is full, sending blocks until it has
+    caught up, so streaming a large payload takes constant memory on both
+    ends.
+
+    If wait is None, this returns an empty dict as soon as the data has been
+    handed off. Otherwise, it waits for the receiver to acknowledge that the
+    data has been written to its child, and returns a dict with how many
+    bytes that was as "written". If wait is a non-empty dict of Waiter
+    arguments, it then also waits for the command to be done, and adds how
+    many seconds that took as "latency". If the command got cancelled (see
+    Relay.prioritize()) before it was written, the dict has "cancelled" set
+    instead.
+
+    Raises socket.timeout if the receiver doesn't get back to us within
+    `timeout` seconds.
+    """
+    with trace("connect", receiver=receiver.pid) as span:
+        sock = connect_to_receiver(receiver.pid, receiver.slot)
+        if sock is None:
+            span.note(error="no control socket")
+    if sock is None:
+        return None
+
+    with sock, sock.makefile("rb") as rfile:
+        sock.settimeout(timeout)
+        with trace("send", receiver=receiver.pid):
+            for message in encode_stuff(data, wait, priority):
+                sock.sendall(message)
+
+        with trace("reply", receiver=receiver.pid):
+            return read_stuff_reply(rfile, wait)
+
+
+def encode_stuff(data, wait=None, priority=None):
+    """
+    Yield the messages that stuff the given data (either bytes, or a binary
+    file to stream from) into a receiver as a single command. See
+    stuff_over_socket() for wait and priority.
+    """
+    # time.monotonic() is the same clock in every process, so the receiver
+    # can tell how long delivery took.
+    final = {"op": "stuff", "more": False, "sent_at": time.monotonic()}
+    if _tracer is not None:
+        # So the receiver's spans for this command can be matched up with
+        # ours.
+        final["trace"] = _tracer.trace_id
+    if wait is not None:
+        final.update(ack=True, wait=wait or None)
+
+    # "more" tells the receiver not to let anybody else stuff anything into
+    # the middle of our data. The receiver looks at the first message to see
+    # whether the command gets to jump the line.
+    for i, (chunk, more) in enumerate(iter_chunks(data)):
+        header = {"op": "stuff", "more": True} if more else final
+        if i == 0 and priority is not None:
+            header = dict(header, priority=priority)
+        yield encode_message(header, chunk)
+
+
+def read_stuff_reply(rfile, wait=None):
+    """
+    Read the receiver's reply to a command sent with encode_stuff(). See
+    stuff_over_socket() for what it returns.
+    """
+    reply = StuffReply(wait)
+    if not reply.complete:
+        for header, body in read_messages(rfile):
+            if reply.on_message(header):
+                break
+
+    return reply.result()
+
+
+class StuffReply:
+    """
+    Puts together the receiver's reply to a command sent with encode_stuff()
+    from the messages it sends back.
+    """
+
+    def __init__(self, wait=None):
+        self.wait = wait
+        self.reply = {}
+        # There's nothing to wait for if the sender didn't ask.
+        self.complete = wait is None
+        self.stuffed_at = time.monotonic()
+
+    def on_message(self, header):
+        """
+        Returns True once there's nothing more to wait for.
+        """
+        if header["op"] == "stuffed":
+            self.reply["written"] = header["written"]
+            self.stuffed_at = time.monotonic()
+            self.complete = not self.wait
+        elif header["op"] == "done":
+            self.reply["latency"] = header["latency"]
+            self.complete = True
+        elif header["op"] == "cancelled":
+            self.reply["cancelled"] = True
+            self.complete = True
+
+        return self.complete
+
+    def result(self):
+        """
+        Return the reply, once the receiver has sent all of it or hung up.
+        """
+        if self.wait is None or self.reply.get("cancelled"):
+            return self.reply
+
+        if "written" not in self.reply:
+            # The receiver went away before it got to our data.
+            raise ConnectionResetError("receiver exited before stuffing")
+
+        if self.wait and "latency" not in self.reply:
+            # The receiver exited, which certainly means the command is done.
+            self.reply["latency"] = time.monotonic() - self.stuffed_at
+
+        return self.reply
+
+
+def listen_on_control_socket(pid, slot=None):
+    """
+    Listen on the control socket for the given pid (and slot). Returns the
+    listening socket, or None if we could not create one (in which case
+    senders will fall back to the spool + SIGUSR1 handoff).
+    """
+    socket_file = get_socket_file(pid, slot)
+    if os.path.exists(socket_file):
+        # A leftover from a dead process that had our pid.
+        os.unlink(socket_file)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(socket_file)
+    except OSError:
+        # Most likely the path is too long for a unix socket.
+        server.close()
+        return None
+
+    server.listen()
+    return server
+
+
+def get_process_command(pid):
+    """
+    Return the command line of the given pid the way `ps -o command` would
+    show it, or None if there is no such process.
+
+    This reads /proc directly when it is available, and falls back to psutil
+    elsewhere. Either way, no subprocesses get forked.
+    """
+    if os.path.isdir(PROC_DIR):
+        try:
+            with open(os.path.join(PROC_DIR, str(pid), "cmdline"), "rb") as f:
+                cmdline = f.read()
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            return None
+
+        return cmdline.replace(b"\0", b" ").decode("utf8", "replace").strip()
+
+    import psutil
+
+    try:
+        return " ".join(psutil.Process(pid).cmdline()).strip()
+    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+        return None
+
+
+def read_proc_stat(pid):
+    """
+    Return the fields of /proc/PID/stat that come after the command name
+    (so the first one is the process state), or None if there is no such
+    process.
+    """
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), "stat"), "rb") as f:
+            stat = f.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+
+    # The second field is the command name in parens, which may itself
+    # contain spaces and parens, so split on the *last* paren.
+    return stat[stat.rindex(b")") + 2 :].split()
+
+
+def get_parent_pid(pid):
+    """
+    Return the parent pid of the given pid, or None if it has no (visible)
+    parent.
+    """
+    if not os.path.isdir(PROC_DIR):
+        import psutil
+
+        try:
+            return psutil.Process(pid).ppid() or None
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+            return None
+
+    stat = read_proc_stat(pid)
+    if stat is None:
+        return None
+
+    return int(stat[1]) or None
+
+
+def get_process_start_time(pid):
+    """
+    Return an opaque value identifying when the given pid started, or None
+    if there is no such process. Together, the pid and its start time
+    identify a process even when pids get reused.
+    """
+    if os.path.isdir(PROC_DIR):
+        stat = read_proc_stat(pid)
+        if stat is None:
+            return None
+
+        # In clock ticks since boot.
+        return int(stat[19])
+
+    import psutil
+
+    try:
+        return int(psutil.Process(pid).create_time() * 1000)
+    except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+        return None
+
+
+def get_receiver(pid):
+    return Receiver(pid, get_process_start_time(pid))
+
+
+def get_ancestor_pids(pid=None):
+    """
+    Return the pids of all the ancestors of the given pid (defaults to this
+    process), nearest first.
+    """
+    if pid is None:
+        pid = os.getpid()
+
+    if not os.path.isdir(PROC_DIR):
+        import psutil
+
+        return [parent.pid for parent in psutil.Process(pid).parents()]
+
+    ancestors = []
+    ppid = get_parent_pid(pid)
+    while ppid is not None and ppid != pid:
+        ancestors.append(ppid)
+        pid, ppid = ppid, get_parent_pid(ppid)
+
+    return ancestors
+
+
+def find_nearest_shtuff_process():
+    for pid in get_ancestor_pids():
+        if get_process_command(pid) == "shtuff":
+            return pid
+
+    return None
+
+
+def receiver_token(receiver):
+    """
+    Return the value of SHTUFF_RECEIVER for the children of the given
+    receiver (see find_nearest_receiver()).
+    """
+    start_time = "" if receiver.start_time is None else receiver.start_time
+    token = f"{receiver.pid}:{start_time}"
+    if receiver.slot is not None:
+        token += f":{receiver.slot}"
+    return token
+
+
+def parse_receiver_token(token):
+    """
+    The opposite of receiver_token(). Returns None if the token is
+    malformed.
+    """
+    try:
+        pid, start_time, *slot = token.split(":")
+        return Receiver(
+            int(pid),
+            int(start_time) if start_time else None,
+            int(slot[0]) if slot else None,
+        )
+    except (ValueError, IndexError):
+        return None
+
+
+def find_nearest_receiver():
+    """
+    Return the Receiver this process is running in, or None if it isn't
+    running in one.
+    """
+    # Receivers tell the shells they start who they are in SHTUFF_RECEIVER.
+    # That gets inherited by anything started from the shell, including
+    # things that end up outside of it (a tmux server, say), so we only take
+    # its word for it if we're still in the session of a shell it started
+    # (and, if so, it's still running). Otherwise, fall back to looking for
+    # a shtuff among our ancestors.
+    receiver = parse_receiver_token(os.environ.get("SHTUFF_RECEIVER", ""))
+    if receiver is not None and get_parent_pid(os.getsid(0)) == receiver.pid:
+        return receiver
+
+    pid = find_nearest_shtuff_process()
+    if pid is None:
+        return None
+
+    if receiver is not None and receiver.pid == pid:
+        # It's the right receiver after all, we've just left its shell's
+        # session. Supervised shells only know which slot they're in from
+        # the token.
+        return receiver
+
+    return get_receiver(pid)
+
+
+def copy_window_size(fd, process):
+    """
+    Give the pty of the given pexpect process the size of the terminal on fd.
+    Does nothing if fd isn't a terminal (or isn't one anymore).
+    """
+    s = struct.pack("HHHH", 0, 0, 0, 0)
+    try:
+        rows, cols, _, _ = struct.unpack("hhhh", fcntl.ioctl(fd, termios.TIOCGWINSZ, s))
+    except OSError:
+        return
+
+    process.setwinsize(rows, cols)
+
+
+def spawn_and_stuff(to_spawn, to_stuff=None, name=None, groups=(), client=None):
+    """
+    Run to_spawn on a pty of its own, relay between it and our terminal, and
+    stuff whatever receivers get sent into it, until it exits. If we were
+    forked by a zygote, client is the connection to our terminal's thin
+    client (see hand_off_terminal()).
+    """
+    import shutil
+    import pexpect
+    import setproctitle
+
+    setproctitle.setproctitle("shtuff")
+
+    receiver = get_receiver(os.getpid())
+    env = dict(os.environ, SHTUFF_RECEIVER=receiver_token(receiver))
+    p = pexpect.spawn(to_spawn, env=env)
+    relay = Relay(p.child_fd, sys.stdin.fileno(), sys.stdout.fileno())
+
+    def resize():
+        copy_window_size(sys.stdout.fileno(), p)
+
+    # Trap SIGWINCH and pass it down to our spawned process.
+    relay.on_signal(signal.SIGWINCH, resize)
+    resize()
+
+    if client is not None:
+        # We're not in our terminal's session, so the thin client passes on
+        # SIGWINCH for us, and hangs up if the terminal goes away.
+        client_rbuf = bytearray()
+
+        def on_client(events):
+            headers = read_thin_client_messages(client, client_rbuf)
+            if headers is None:
+                relay.watch(client, 0, None)
+                p.kill(signal.SIGHUP)
+                return
+
+            if any(header["op"] == "resize" for header in headers):
+                resize()
+
+        client.setblocking(False)
+        relay.watch(client, selectors.EVENT_READ, on_client)
+
+    shtuff_pid = os.getpid()
+
+    spool_dir = get_spool_dir(shtuff_pid)
+    # Anything in here was left behind by a dead process that had our pid.
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    os.mkdir(spool_dir)
+
+    def read_and_stuff_command():
+        # Signals don't queue up, so one SIGUSR1 may stand for any number of
+        # commands. Stuff everything that's waiting.
+        try:
+            for data, sent_at, priority in drain_spool(shtuff_pid):
+                relay.stuff(data, sent_at, priority)
+        except (OSError, ValueError):
+            relay.stats.failed_deliveries += 1
+
+        # Senders from before we had a spool write a single command file.
+        cmd_file = get_cmd_file(shtuff_pid)
+        try:
+            with open(cmd_file, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        except OSError:
+            relay.stats.failed_deliveries += 1
+            return
+
+        os.unlink(cmd_file)
+        relay.stuff(data)
+
+    relay.on_signal(signal.SIGUSR1, read_and_stuff_command)
+
+    server = listen_on_control_socket(shtuff_pid)
+    if server is not None:
+        relay.serve(server)
+
+    if to_stuff:
+        relay.stuff(to_stuff.encode("utf8"))
+
+    if name:
+        for data in write_shtuff_pid(name, shtuff_pid, groups):
+            relay.stuff(data)
+
+    # Clean up after any receivers that have died since the last time.
+    prune_registry()
+
+    try:
+        relay.run()
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        if server is not None:
+            server.close()
+            os.unlink(get_socket_file(shtuff_pid))
+
+    if client is not None:
+        if not relay.child_open:
+            # The child closed its pty on its way out, so this won't be long.
+            p.wait()
+        p.close()
+        with client:
+            send_exit_status(client, p)
+
+
+class Stuffer:
+    """
+    Somewhere data to stuff into the child comes from: a connection to the
+    control socket, or the receiver itself (for the spool and `shtuff new`).
+    """
+
+    def __init__(self, chunks=()):
+        self.chunks = deque(chunks)
+        # Set while a stream of several messages is coming in, so nobody else
+        # gets to stuff anything into the middle of it.
+        self.streaming = False
+        # Set if the command that's streaming in got cancelled, so the rest
+        # of it gets thrown away as it arrives.
+        self.cancelling = False
+        self.closed = False
+
+
+class Connection(Stuffer):
+    def __init__(self, sock, on_ready):
+        super().__init__()
+        self.sock = sock
+        self.rbuf = bytearray()
+        # Encoded messages on their way to the other end. Output is encoded
+        # once and the same bytes are queued for everybody following it.
+        self.outbox = deque()
+        self.outbox_size = 0
+        # How much of the first message in the outbox has been sent.
+        self.outbox_sent = 0
+        # Set for `shtuff attach` viewers, who get skipped ahead rather than
+        # dropped when they fall behind.
+        self.skip_ahead = False
+        # How much of the command currently coming in we've received, and
+        # when it started coming in (only kept track of when tracing).
+        self.command_size = 0
+        self.command_started_at = None
+        # The callback for the event loop.
+        self.on_ready = lambda events: on_ready(self, events)
+
+
+# Marks the end of a command. Once the relay gets to it, all of the command
+# has been written to the child. sent_at is when the sender sent it (by
+# time.monotonic(), or None if we don't know). If ack is set, the sender gets
+# told how much was written, and wait is None, or a dict of Waiter arguments
+# if the sender also wants to hear when the command is done. If tracing is on
+# (see Tracer), trace is the sender's trace id (or None if it wasn't tracing)
+# and when we started receiving the command.
+Stuffed = namedtuple(
+    "Stuffed", ["written", "sent_at", "ack", "wait", "trace"], defaults=[None]
+)
+
+
+class Waiter:
+    """
+    Somebody waiting to hear that the command they stuffed is done: the child
+    has printed something matching `prompt` since, or has gone `quiet`
+    seconds without printing anything.
+    """
+
+    # How much of the most recent output to look for the prompt in.
+    PROMPT_WINDOW = 4096
+
+    def __init__(self, conn, quiet=None, prompt=None):
+        import re
+
+        self.conn = conn
+        self.quiet = quiet
+        self.prompt = None
+        if prompt is not None:
+            try:
+                self.prompt = re.compile(prompt.encode("utf8"))
+            except re.error as e:
+                raise ValueError(f"invalid prompt: {e}") from e
+        self.stuffed_at = time.monotonic()
+        self.last_output_at = self.stuffed_at
+        self.output = bytearray()
+        self.done = False
+
+    def on_output(self, data):
+        if self.done:
+            return
+
+        self.last_output_at = time.monotonic()
+        if self.prompt is not None:
+            self.output += data
+            del self.output[: -self.PROMPT_WINDOW]
+            self.done = self.prompt.search(self.output) is not None
+
+
+class Stats:
+    """
+    Cheap counters describing what a receiver has been up to, for `shtuff
+    stats`.
+    """
+
+    # Upper bounds (in seconds) of the buckets of the delivery latency
+    # histogram. Anything slower goes in one last bucket.
+    LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.commands = 0
+        self.bytes_stuffed = 0
+        self.bytes_output = 0
+        self.failed_deliveries = 0
+        # Commands thrown away by `shtuff into --interrupt` or `--cancel`.
+        self.cancelled = 0
+        # How long it took from a sender sending a command until we were done
+        # writing it to the child.
+        self.latency_histogram = [0] * (len(self.LATENCY_BUCKETS) + 1)
+
+    def record_latency(self, seconds):
+        self.latency_histogram[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    def as_dict(self):
+        return {
+            "uptime": time.time() - self.started_at,
+            "commands": self.commands,
+            "bytes_stuffed": self.bytes_stuffed,
+            "bytes_output": self.bytes_output,
+            "failed_deliveries": self.failed_deliveries,
+            "cancelled": self.cancelled,
+            "latency_buckets": self.LATENCY_BUCKETS,
+            "latency_histogram": self.latency_histogram,
+        }
+
+
+class RingBuffer:
+    """
+    A fixed-size buffer that remembers the most recent bytes written to it.
+    Its memory is allocated once, up front.
+    """
+
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.size = size
+        # Where the next byte will go.
+        self.end = 0
+        self.filled = 0
+
+    def write(self, data):
+        view = memoryview(data)[-self.size :]
+        first = min(len(view), self.size - self.end)
+        self.buf[self.end : self.end + first] = view[:first]
+        self.buf[: len(view) - first] = view[first:]
+        self.end = (self.end + len(view)) % self.size
+        self.filled = min(self.size, self.filled + len(view))
+
+    def read(self, size=None):
+        """
+        Return the most recent `size` bytes (everything we have by default).
+        """
+        size = self.filled if size is None else max(0, min(size, self.filled))
+        start = (self.end - size) % self.size
+        if start + size <= self.size:
+            return bytes(self.buf[start : start + size])
+
+        return bytes(self.buf[start:] + self.buf[: self.end])
+
+
+def flush_pty_input(fd):
+    """
+    Throw away whatever has been written to the pty with the given master fd
+    that hasn't been read from its other end yet. Does nothing where we can't
+    get at the other end (it takes TIOCGPTPEER, from Linux 4.13).
+    """
+    # From <asm-generic/ioctls.h>.
+    TIOCGPTPEER = 0x5441
+    try:
+        peer = fcntl.ioctl(fd, TIOCGPTPEER, os.O_RDWR | os.O_NOCTTY | os.O_CLOEXEC)
+    except OSError:
+        return
+
+    try:
+        termios.tcflush(peer, termios.TCIFLUSH)
+    except termios.error:
+        pass
+    finally:
+        os.close(peer)
+
+
+class Relay:
+    """
+    The event loop at the heart of a receiver. It relays the user's typing to
+    the child's pty and the child's output back to the user's terminal, and
+    stuffs in whatever arrives over the control socket, all from one thread.
+
+    The child's output is read in large chunks, and whatever piles up while
+    the terminal is busy goes out in a single write. Signals are turned into
+    events on the loop (see on_signal()) rather than interrupting it.
+
+    Data usually goes from a pty to a terminal, and splice(2) needs one end to
+    be a pipe, so this sticks to plain reads and writes.
+    """
+
+    READ_SIZE = 64 * 1024
+    # How much we write to the child's pty at once. Feeding it in small pieces
+    # as it becomes writable keeps us from overrunning its tty input buffer.
+    PTY_WRITE_SIZE = 4096
+    # Stop reading the child's output while this much of it is waiting for
+    # the terminal, so a slow terminal slows down the child instead of making
+    # us buffer without bound.
+    MAX_PENDING_OUTPUT = 1024 * 1024
+    # How much of the child's recent output we remember for `shtuff tail`.
+    OUTPUT_HISTORY_SIZE = 256 * 1024
+    # Drop anybody following the output with `shtuff tail --follow` (or skip
+    # `shtuff attach` viewers ahead) if this much of it piles up waiting for
+    # them, rather than buffering without bound.
+    MAX_PENDING_FOLLOW = 1024 * 1024
+    # How many queued messages to hand to a single sendmsg().
+    MAX_SEND_BUFFERS = 64
+
+    def __init__(self, child_fd, stdin_fd, stdout_fd, selector=None):
+        # A Supervisor runs many relays on one selector.
+        self.selector = selector or selectors.DefaultSelector()
+        self.child_fd = child_fd
+        self.stdin_fd = stdin_fd
+        self.stdout_fd = stdout_fd
+        self.child_open = True
+        self.stdin_open = True
+        self.stdout_open = True
+        # Typed by the user, on its way to the child.
+        self.typed = bytearray()
+        # Stuffed by somebody, on its way to the child.
+        self.stuffing = bytearray()
+        # Printed by the child, on its way to the user's terminal.
+        self.output = bytearray()
+        self.history = RingBuffer(self.OUTPUT_HISTORY_SIZE)
+        # Stuffers with commands for the child, in line. Priority commands
+        # (`shtuff into --priority`) get a line of their own, which goes
+        # first.
+        self.stuffers = deque()
+        self.urgent = deque()
+        # The stuffer whose command we're in the middle of writing to the
+        # child, if any. Nobody else gets a turn until it's done.
+        self.typing = None
+        self.connections = set()
+        self.followers = set()
+        self.waiters = []
+        self.stats = Stats()
+        self.signal_handlers = {}
+        self.interest = {}
+        self.stdout_was_blocking = True
+        self.old_tty_attrs = None
+
+    def on_signal(self, signum, handler):
+        """
+        Call handler() from the event loop whenever we receive the given
+        signal.
+        """
+        self.signal_handlers[signum] = handler
+        # The real work happens when set_wakeup_fd() wakes up the loop.
+        signal.signal(signum, lambda sig, data: None)
+
+    def serve(self, server):
+        """
+        Accept connections to the given control socket.
+        """
+        server.setblocking(False)
+        self.watch(server, selectors.EVENT_READ, lambda events: self.on_accept(server))
+
+    def stuff(self, data, sent_at=None, priority=None):
+        """
+        Queue up the given bytes to be stuffed into the child. See
+        prioritize() for priority.
+        """
+        self.stats.commands += 1
+        trace = None if _tracer is None else (None, time.monotonic())
+        stuffer = Stuffer(
+            [data, Stuffed(len(data), sent_at, ack=False, wait=None, trace=trace)]
+        )
+        self.prioritize(priority)
+        (self.stuffers if priority is None else self.urgent).append(stuffer)
+
+    def prioritize(self, priority):
+        """
+        Make way for a command with the given priority options: None for an
+        ordinary command, or a dict (see get_priority_options()) for one that
+        goes ahead of every command waiting its turn. With "interrupt", the
+        command we're in the middle of writing (if any) gets abandoned, and
+        the child gets sent its interrupt character (usually Ctrl-C) right
+        away. With "cancel", every ordinary command waiting its turn gets
+        thrown away.
+        """
+        if priority is None:
+            return
+
+        if priority.get("interrupt"):
+            self.abandon_typing()
+            # Pressing Ctrl-C throws away whatever input hasn't been read yet,
+            # but only once it gets to the head of the line. Don't make it
+            # wait behind a full input buffer.
+            flush_pty_input(self.child_fd)
+            try:
+                intr = termios.tcgetattr(self.child_fd)[6][termios.VINTR]
+            except termios.error:
+                intr = b"\x03"
+            self.stuffing += intr
+
+        if priority.get("cancel"):
+            for stuffer in self.stuffers:
+                self.cancel_waiting(stuffer)
+
+        if self.stuffing and self.child_open:
+            # Don't wait for the next go around the loop.
+            self.on_child(selectors.EVENT_WRITE)
+
+    def abandon_typing(self):
+        """
+        Stop writing the command we're in the middle of, and throw away the
+        rest of it.
+        """
+        self.stuffing.clear()
+        stuffer, self.typing = self.typing, None
+        if stuffer is None:
+            return
+
+        while stuffer.chunks:
+            chunk = stuffer.chunks.popleft()
+            if isinstance(chunk, Stuffed):
+                self.on_cancelled(stuffer, chunk)
+                return
+
+        # The rest of it hasn't even arrived yet.
+        stuffer.cancelling = stuffer.streaming
+
+    def cancel_waiting(self, stuffer):
+        """
+        Throw away the given stuffer's commands that are waiting their turn.
+        """
+        kept = deque()
+        if stuffer is self.typing:
+            # Let it finish the command it's in the middle of.
+            while stuffer.chunks:
+                chunk = stuffer.chunks.popleft()
+                kept.append(chunk)
+                if isinstance(chunk, Stuffed):
+                    break
+            else:
+                stuffer.chunks = kept
+                return
+
+        for chunk in stuffer.chunks:
+            if isinstance(chunk, Stuffed):
+                self.on_cancelled(stuffer, chunk)
+        stuffer.chunks = kept
+        stuffer.cancelling = stuffer.streaming
+
+    def on_cancelled(self, stuffer, stuffed):
+        self.stats.cancelled += 1
+        if stuffed.ack and not stuffer.closed:
+            self.send(stuffer, {"op": "cancelled"})
+
+    def watch(self, fileobj, events, callback):
+        """
+        Call callback(events) when fileobj is ready for any of the given
+        events (a combination of selectors.EVENT_READ and EVENT_WRITE), or stop
+        watching it if events is 0.
+        """
+        if self.interest.get(fileobj) == (events, callback):
+            return
+
+        if fileobj in self.interest:
+            if events:
+                self.selector.modify(fileobj, events, callback)
+            else:
+                self.selector.unregister(fileobj)
+                del self.interest[fileobj]
+                return
+        elif events:
+            self.selector.register(fileobj, events, callback)
+        else:
+            return
+
+        self.interest[fileobj] = (events, callback)
+
+    def start(self):
+        """
+        Get the terminal and the child's pty ready for relaying. stop() puts
+        them back the way they were.
+        """
+        import tty
+
+        # We share stdout with whoever started us, so put it back the way we
+        # found it when we're done.
+        self.stdout_was_blocking = os.get_blocking(self.stdout_fd)
+        os.set_blocking(self.stdout_fd, False)
+        os.set_blocking(self.child_fd, False)
+
+        if os.isatty(self.stdin_fd):
+            self.old_tty_attrs = termios.tcgetattr(self.stdin_fd)
+            tty.setraw(self.stdin_fd)
+
+    @property
+    def running(self):
+        # Keep going after the child is gone until the terminal has seen
+        # everything it printed on its way out.
+        return self.child_open or (self.output and self.stdout_open)
+
+    def update(self):
+        """
+        Watch for whatever we can make progress on now. Returns how long the
+        event loop may wait before calling check_waiters() again.
+        """
+        READ, WRITE = selectors.EVENT_READ, selectors.EVENT_WRITE
+
+        child_events = 0
+        if self.child_open:
+            if len(self.output) < self.MAX_PENDING_OUTPUT:
+                child_events |= READ
+            if self.typed or self.next_stuffing():
+                child_events |= WRITE
+        self.watch(self.child_fd, child_events, self.on_child)
+
+        stdin_events = READ if self.stdin_open and not self.typed else 0
+        self.watch(self.stdin_fd, stdin_events, self.on_stdin)
+
+        stdout_events = WRITE if self.output and self.stdout_open else 0
+        self.watch(self.stdout_fd, stdout_events, self.on_stdout)
+
+        for conn in self.connections:
+            # Don't read any more from a connection until what it has already
+            # sent has been stuffed.
+            conn_events = 0 if conn.chunks else READ
+            if conn.outbox:
+                conn_events |= WRITE
+            self.watch(conn.sock, conn_events, conn.on_ready)
+
+        return self.check_waiters()
+
+    def stop(self):
+        if self.old_tty_attrs is not None:
+            try:
+                termios.tcsetattr(self.stdin_fd, termios.TCSAFLUSH, self.old_tty_attrs)
+            except termios.error:
+                # The terminal has gone away.
+                pass
+            self.old_tty_attrs = None
+        try:
+            os.set_blocking(self.stdout_fd, self.stdout_was_blocking)
+        except OSError:
+            pass
+        for conn in list(self.connections):
+            self.close_connection(conn)
+        for fileobj in list(self.interest):
+            self.watch(fileobj, 0, None)
+
+    def run(self):
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        old_wakeup_fd = signal.set_wakeup_fd(self.wakeup_w.fileno())
+        self.watch(self.wakeup_r, selectors.EVENT_READ, self.on_wakeup)
+
+        self.start()
+        try:
+            while self.running:
+                for key, events in self.selector.select(self.update()):
+                    key.data(events)
+        finally:
+            self.stop()
+            signal.set_wakeup_fd(old_wakeup_fd)
+
+    def next_stuffing(self):
+        """
+        Return the buffer of stuffed data waiting to be written to the child,
+        refilling it from the next stuffer in line if it's empty.
+        """
+        while not self.stuffing:
+            # Priority commands go first, but don't cut into a command that's
+            # halfway written.
+            if self.typing is not None:
+                stuffer = self.typing
+                line = self.urgent if stuffer in self.urgent else self.stuffers
+            elif self.urgent:
+                stuffer, line = self.urgent[0], self.urgent
+            elif self.stuffers:
+                stuffer, line = self.stuffers[0], self.stuffers
+            else:
+                break
+
+            if stuffer.chunks:
+                chunk = stuffer.chunks.popleft()
+                if isinstance(chunk, Stuffed):
+                    # Everything before this has been written to the child.
+                    self.typing = None
+                    self.on_stuffed(stuffer, chunk)
+                else:
+                    self.typing = stuffer
+                    self.stuffing += chunk
+            elif stuffer.streaming:
+                # Wait for the rest of the stream.
+                break
+            else:
+                self.typing = None
+                line.remove(stuffer)
+
+        return self.stuffing
+
+    def on_wakeup(self, events):
+        try:
+            signums = self.wakeup_r.recv(4096)
+        except BlockingIOError:
+            return
+
+        for signum in signums:
+            handler = self.signal_handlers.get(signum)
+            if handler is not None:
+                handler()
+
+    def on_child(self, events):
+        if events & selectors.EVENT_READ:
+            try:
+                data = os.read(self.child_fd, self.READ_SIZE)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                # EIO once the child's side of the pty is closed and empty.
+                data = b""
+
+            if data == b"":
+                self.child_open = False
+                self.watch(self.child_fd, 0, None)
+                return
+
+            if data:
+                self.on_output(data)
+
+        if events & selectors.EVENT_WRITE:
+            # Whatever the user types goes ahead of stuffed data.
+            buf = self.typed or self.next_stuffing()
+            try:
+                written = os.write(self.child_fd, buf[: self.PTY_WRITE_SIZE])
+            except BlockingIOError:
+                return
+            except OSError:
+                self.child_open = False
+                self.watch(self.child_fd, 0, None)
+                return
+
+            if buf is self.stuffing:
+                self.stats.bytes_stuffed += written
+            del buf[:written]
+
+    def on_output(self, data):
+        """
+        Called with everything the child prints.
+        """
+        self.stats.bytes_output += len(data)
+        self.history.write(data)
+        for waiter in self.waiters:
+            waiter.on_output(data)
+
+        if self.followers:
+            message = encode_message({"op": "output"}, data)
+            for conn in list(self.followers):
+                if conn.outbox_size <= self.MAX_PENDING_FOLLOW:
+                    self.queue(conn, message)
+                elif conn.skip_ahead:
+                    self.skip_ahead(conn)
+                    self.queue(conn, message)
+                else:
+                    self.close_connection(conn)
+
+        if not self.stdout_open:
+            return
+
+        self.output += data
+        if len(self.output) == len(data):
+            # The terminal was idle, so don't wait for the next go around the
+            # loop to find out it's writable.
+            self.on_stdout(None)
+
+    def on_stdout(self, events):
+        try:
+            written = os.write(self.stdout_fd, self.output)
+        except BlockingIOError:
+            return
+        except OSError:
+            # The terminal went away. Nobody is going to see the output.
+            self.stdout_open = False
+            self.output.clear()
+            return
+
+        del self.output[:written]
+
+    def on_stdin(self, events):
+        try:
+            data = os.read(self.stdin_fd, self.READ_SIZE)
+        except OSError:
+            data = b""
+
+        if not data:
+            self.stdin_open = False
+            self.watch(self.stdin_fd, 0, None)
+            return
+
+        self.typed += data
+
+    def on_accept(self, server):
+        try:
+            sock, _ = server.accept()
+        except BlockingIOError:
+            return
+
+        sock.setblocking(False)
+        self.connections.add(Connection(sock, self.on_connection))
+
+    def send(self, conn, header, body=b""):
+        """
+        Send a message over the given connection, without blocking.
+        """
+        self.queue(conn, encode_message(header, body))
+
+    def queue(self, conn, message):
+        idle = not conn.outbox
+        conn.outbox.append(message)
+        conn.outbox_size += len(message)
+        if idle:
+            self.flush_connection(conn)
+
+    def skip_ahead(self, conn):
+        """
+        Throw away everything queued up for a viewer that has fallen behind
+        (except what's left of a message it has already started getting), and
+        tell it how much it missed.
+        """
+        kept = [conn.outbox.popleft()] if conn.outbox_sent else []
+        skipped = conn.outbox_size - sum(len(message) for message in kept)
+        conn.outbox = deque(kept)
+        conn.outbox_size -= skipped
+        self.queue(conn, encode_message({"op": "skipped", "size": skipped}))
+
+    def flush_connection(self, conn):
+        buffers = [memoryview(conn.outbox[0])[conn.outbox_sent :]]
+        buffers.extend(itertools.islice(conn.outbox, 1, self.MAX_SEND_BUFFERS))
+        try:
+            sent = conn.sock.sendmsg(buffers)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close_connection(conn)
+            return
+
+        conn.outbox_size -= sent
+        sent += conn.outbox_sent
+        while conn.outbox and sent >= len(conn.outbox[0]):
+            sent -= len(conn.outbox.popleft())
+        conn.outbox_sent = sent
+
+    def on_connection(self, conn, events):
+        if conn.closed:
+            # Closed by an earlier callback from the same select().
+            return
+
+        if events & selectors.EVENT_WRITE:
+            self.flush_connection(conn)
+
+        if conn.closed or not events & selectors.EVENT_READ:
+            return
+
+        try:
+            data = conn.sock.recv(self.READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.close_connection(conn)
+            return
+
+        conn.rbuf += data
+        try:
+            message = parse_message(conn.rbuf)
+            while message is not None:
+                self.handle_message(conn, *message)
+                message = parse_message(conn.rbuf)
+        except (ValueError, KeyError):
+            # A misbehaving sender shouldn't take down the receiver.
+            self.stats.failed_deliveries += 1
+            self.close_connection(conn)
+
+    def on_stuffed(self, stuffer, stuffed):
+        if stuffed.sent_at is not None:
+            self.stats.record_latency(time.monotonic() - stuffed.sent_at)
+
+        if stuffed.trace is not None:
+            # From when the command started coming in until all of it has
+            # been written to the child.
+            trace_id, started_at = stuffed.trace
+            _tracer.log(
+                "receive",
+                started_at,
+                trace_id=trace_id,
+                written=stuffed.written,
+                sent_at=stuffed.sent_at,
+            )
+
+        # Only a connection asks for an acknowledgement.
+        if not stuffed.ack or stuffer.closed:
+            return
+
+        self.send(stuffer, {"op": "stuffed", "written": stuffed.written})
+        if stuffed.wait is not None:
+            try:
+                self.waiters.append(Waiter(stuffer, **stuffed.wait))
+            except (TypeError, ValueError):
+                # A misbehaving sender shouldn't take down the receiver.
+                self.close_connection(stuffer)
+
+    def check_waiters(self):
+        """
+        Tell everybody waiting for their command to finish whether it has.
+        Returns how many seconds until we need to check again, or None if
+        nobody is waiting on the clock.
+        """
+        now = time.monotonic()
+        timeout = None
+        for waiter in list(self.waiters):
+            if waiter.done:
+                latency = waiter.last_output_at - waiter.stuffed_at
+            elif waiter.quiet is None:
+                continue
+            else:
+                quiet_until = waiter.last_output_at + waiter.quiet
+                if now < quiet_until:
+                    remaining = quiet_until - now
+                    timeout = remaining if timeout is None else min(timeout, remaining)
+                    continue
+                latency = waiter.last_output_at - waiter.stuffed_at
+
+            self.waiters.remove(waiter)
+            self.send(waiter.conn, {"op": "done", "latency": latency})
+
+        return timeout
+
+    def handle_message(self, conn, header, body):
+        if header["op"] == "stuff":
+            priority = None
+            if not conn.streaming:
+                if _tracer is not None:
+                    conn.command_started_at = time.monotonic()
+                # The first message of a command says how urgent it is.
+                priority = header.get("priority")
+                self.prioritize(priority)
+
+            more = header.get("more", False)
+            if conn.cancelling:
+                conn.streaming = conn.cancelling = more
+                if not more:
+                    self.stats.commands += 1
+                    conn.command_size = 0
+                    stuffed = Stuffed(0, None, header.get("ack", False), None)
+                    if _tracer is not None:
+                        _tracer.log(
+                            "receive",
+                            conn.command_started_at,
+                            trace_id=header.get("trace"),
+                            cancelled=True,
+                        )
+                    self.on_cancelled(conn, stuffed)
+                return
+
+            if body:
+                conn.chunks.append(body)
+                conn.command_size += len(body)
+            conn.streaming = more
+            if not conn.streaming:
+                self.stats.commands += 1
+                conn.chunks.append(
+                    Stuffed(
+                        conn.command_size,
+                        header.get("sent_at"),
+                        header.get("ack", False),
+                        header.get("wait"),
+                        None
+                        if _tracer is None
+                        else (header.get("trace"), conn.command_started_at),
+                    )
+                )
+                conn.command_size = 0
+            if conn not in self.stuffers and conn not in self.urgent:
+                (self.stuffers if priority is None else self.urgent).append(conn)
+            if priority is not None and self.child_open:
+                # Don't wait for the next go around the loop.
+                self.on_child(selectors.EVENT_WRITE)
+        elif header["op"] == "tail":
+            self.send(conn, {"op": "output"}, self.history.read(header["size"]))
+            if header["follow"]:
+                self.followers.add(conn)
+        elif header["op"] == "attach":
+            self.send(conn, {"op": "output"}, self.history.read())
+            conn.skip_ahead = True
+            self.followers.add(conn)
+        elif header["op"] == "stats":
+            stats = json.dumps(self.stats.as_dict()).encode("utf8")
+            self.send(conn, {"op": "stats"}, stats)
+
+    def close_connection(self, conn):
+        self.watch(conn.sock, 0, None)
+        conn.sock.close()
+        conn.closed = True
+        if conn.streaming:
+            # The sender went away in the middle of a command. Whatever it
+            # already sent still gets stuffed, but don't wait for more.
+            self.stats.failed_deliveries += 1
+            conn.streaming = False
+        self.connections.discard(conn)
+        self.followers.discard(conn)
+        self.waiters = [waiter for waiter in self.waiters if waiter.conn is not conn]
+
+
+class Slot:
+    """
+    One receiver hosted by a Supervisor: a child on a pty of its own, relayed
+    to the terminal of the thin client that asked for it.
+    """
+
+    def __init__(self, number, process, relay, client):
+        self.number = number
+        self.process = process
+        self.relay = relay
+        # The thin client's connection, or None once it has hung up.
+        self.client = client
+        self.rbuf = bytearray()
+        self.server = None
+
+    def resize(self):
+        copy_window_size(self.relay.stdout_fd, self.process)
+
+
+class PendingSpawnRequest:
+    """
+    A connection to a Supervisor whose spawn request (see
+    hand_off_terminal()) hasn't all arrived yet.
+    """
+
+    def __init__(self, sock, deadline):
+        self.sock = sock
+        self.buf = bytearray()
+        self.fds = []
+        # When we give up on it.
+        self.deadline = deadline
+
+
+class Supervisor:
+    """
+    A per-user daemon (`shtuff supervisor`) that hosts many receivers in one
+    process, so they don't each need an interpreter of their own. The
+    terminal a receiver belongs to runs a thin client (see THIN_CLIENT) that
+    hands its stdin and stdout over to us and then only passes on resizes
+    and the child's exit status. Everything else works as it does for a
+    standalone receiver: every slot has its own Relay (all on our one
+    selector), its own control socket, and its own names in the registry.
+
+    Children find out which slot they're in from SHTUFF_RECEIVER (see
+    find_nearest_receiver()).
+    """
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.receiver = get_receiver(os.getpid())
+        self.slots = {}
+        self.slot_numbers = itertools.count()
+        self.pending = set()
+
+    def run(self, server):
+        server.setblocking(False)
+        self.selector.register(
+            server, selectors.EVENT_READ, lambda events: self.on_accept(server)
+        )
+        while True:
+            timeout = None
+            now = time.monotonic()
+            for pending in list(self.pending):
+                if now >= pending.deadline:
+                    self.drop_request(pending)
+                    continue
+
+                remaining = pending.deadline - now
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            for slot in list(self.slots.values()):
+                if not slot.relay.running:
+                    self.close_slot(slot)
+                    continue
+
+                slot_timeout = slot.relay.update()
+                if slot_timeout is not None:
+                    timeout = (
+                        slot_timeout if timeout is None else min(timeout, slot_timeout)
+                    )
+
+            for key, events in self.selector.select(timeout):
+                key.data(events)
+
+    def close(self):
+        for pending in list(self.pending):
+            self.drop_request(pending)
+        for slot in list(self.slots.values()):
+            self.close_slot(slot)
+
+    def on_accept(self, server):
+        try:
+            sock, _ = server.accept()
+        except BlockingIOError:
+            return
+
+        # Every slot's relay runs on our one selector, so rather than waiting
+        # for the request here, read it as it comes in.
+        sock.setblocking(False)
+        pending = PendingSpawnRequest(sock, time.monotonic() + SUPERVISOR_TIMEOUT)
+        self.pending.add(pending)
+        self.selector.register(
+            sock, selectors.EVENT_READ, lambda events: self.on_request(pending)
+        )
+
+    def on_request(self, pending):
+        try:
+            data, fds = recv_with_fds(pending.sock, 64 * 1024, 3)
+        except BlockingIOError:
+            return
+        except OSError:
+            data, fds = b"", []
+
+        pending.fds += fds
+        try:
+            if not data:
+                raise EOFError("connection closed in the middle of a request")
+            pending.buf += data
+            request = parse_spawn_request(pending.buf, pending.fds)
+        except (EOFError, ValueError, KeyError):
+            self.drop_request(pending)
+            return
+
+        if request is None:
+            return
+
+        self.pending.remove(pending)
+        self.selector.unregister(pending.sock)
+        stdin_fd, stdout_fd, stderr_fd = pending.fds
+        # We have nowhere to print errors about a single slot.
+        os.close(stderr_fd)
+        self.spawn(pending.sock, request, stdin_fd, stdout_fd)
+
+    def drop_request(self, pending):
+        self.pending.remove(pending)
+        self.selector.unregister(pending.sock)
+        pending.sock.close()
+        for fd in pending.fds:
+            os.close(fd)
+
+    def spawn(self, client, request, stdin_fd, stdout_fd):
+        import pexpect
+
+        number = next(self.slot_numbers)
+        token = receiver_token(self.receiver._replace(slot=number))
+        env = dict(request["env"], SHTUFF_RECEIVER=token)
+        try:
+            process = pexpect.spawn(
+                request["cmd"],
+                cwd=request["cwd"],
+                env=env,
+                preexec_fn=lambda: set_process_limits(request),
+            )
+        except pexpect.ExceptionPexpect:
+            with client:
+                send_message(client, {"op": "exit", "status": 127})
+            os.close(stdin_fd)
+            os.close(stdout_fd)
+            return
+
+        # We reap children that have exited before we close their pty, so
+        # there's no need to give them time to exit then.
+        process.ptyproc.delayafterclose = 0
+
+        relay = Relay(process.child_fd, stdin_fd, stdout_fd, self.selector)
+        slot = Slot(number, process, relay, client)
+        slot.resize()
+        relay.start()
+
+        slot.server = listen_on_control_socket(self.receiver.pid, number)
+        if slot.server is not None:
+            relay.serve(slot.server)
+
+        if request["stuff"]:
+            relay.stuff(request["stuff"].encode("utf8"))
+
+        if request["name"]:
+            for data in write_shtuff_pid(
+                request["name"], self.receiver.pid, request["groups"], number
+            ):
+                relay.stuff(data)
+
+        client.setblocking(False)
+        self.selector.register(
+            client, selectors.EVENT_READ, lambda events: self.on_client(slot)
+        )
+        self.slots[number] = slot
+
+    def on_client(self, slot):
+        headers = read_thin_client_messages(slot.client, slot.rbuf)
+        if headers is None:
+            # The terminal is gone, so hang up on the child, as the terminal
+            # would have.
+            self.selector.unregister(slot.client)
+            slot.client.close()
+            slot.client = None
+            slot.process.kill(signal.SIGHUP)
+            return
+
+        for header in headers:
+            if header["op"] == "resize":
+                slot.resize()
+
+    def close_slot(self, slot):
+        del self.slots[slot.number]
+        slot.relay.stop()
+
+        if not slot.relay.child_open:
+            # The child closed its pty on its way out, so this won't be long.
+            slot.process.wait()
+        # Otherwise, this hangs up on the child and kills it if it has to.
+        slot.process.close()
+
+        if slot.client is not None:
+            self.selector.unregister(slot.client)
+            with slot.client:
+                send_exit_status(slot.client, slot.process)
+
+        os.close(slot.relay.stdin_fd)
+        os.close(slot.relay.stdout_fd)
+        if slot.server is not None:
+            slot.server.close()
+            os.unlink(get_socket_file(self.receiver.pid, slot.number))
+
+        receiver = self.receiver._replace(slot=slot.number)
+        forget_receiver(receiver)
+        ask_broker({"op": "forget", "receiver": receiver})
+
+
+class Zygote:
+    """
+    An optional per-user daemon (`shtuff zygote`) that starts up like a
+    receiver would, up to the point where it needs to know what to run, and
+    then forks a receiver off for every terminal that asks (see
+    fork_from_zygote()). The forks skip starting an interpreter and importing
+    everything, so they're ready about as soon as their shell is.
+
+    A receiver we fork is not a child of its terminal, so its terminal runs
+    a thin client, as for a Supervisor.
+    """
+
+    def warm_up(self):
+        # Everything spawn_and_stuff() would import.
+        import shutil
+        import sqlite3
+        import tty
+        import pexpect
+        import setproctitle
+
+        data_dir()
+
+    def run(self, server):
+        while True:
+            sock, _ = server.accept()
+            spawn_request = read_spawn_request(sock)
+            if spawn_request is not None:
+                self.fork_receiver(server, sock, *spawn_request)
+
+    def fork_receiver(self, server, sock, request, fds):
+        pid = os.fork()
+        if pid != 0:
+            sock.close()
+            for fd in fds:
+                os.close(fd)
+            return
+
+        try:
+            server.close()
+            os.setsid()
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.chdir(request["cwd"])
+            os.environ.clear()
+            os.environ.update(request["env"])
+            set_process_limits(request)
+            # Trace (or not) the way whoever asked for the receiver would.
+            start_tracing()
+
+            spawn_and_stuff(
+                request["cmd"],
+                request["stuff"],
+                request["name"],
+                request["groups"],
+                client=sock,
+            )
+        except BaseException:
+            import traceback
+
+            traceback.print_exc()
+            os._exit(1)
+
+        os._exit(0)
+
+
+class Broker:
+    """
+    An optional per-user daemon (`shtuff broker`) that keeps the registry in
+    memory, so other commands can look receivers up with a single round trip
+    over its socket (see ask_broker()) rather than opening the registry
+    database. It finds out about receivers exiting as it happens, from a
+    pidfd per receiver where the platform has them, and forgets them
+    right away (in the registry too).
+
+    The registry remains the source of truth: receivers register there as
+    always and then tell the broker, and everybody goes back to the registry
+    if there's no broker running.
+    """
+
+    # Without pidfds, how often to check whether receivers are still alive.
+    POLL_INTERVAL = 1
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # name -> Receiver
+        self.receivers = {}
+        # Receiver -> set of names, so `shtuff whoami` needn't look through
+        # every receiver.
+        self.names = {}
+        # group -> set of names
+        self.groups = {}
+        # Receiver -> pidfd, or None if we have to poll to see whether it's
+        # still alive.
+        self.watched = {}
+
+    def load(self):
+        # We're already listening, but asking ourselves would only get us
+        # an answer once we're done here.
+        for name, receiver in prune_registry(use_broker=False).items():
+            self.register(name, receiver)
+
+        for group, name in open_registry().execute("SELECT grp, name FROM groups"):
+            if name in self.receivers:
+                self.groups.setdefault(group, set()).add(name)
+
+    def register(self, name, receiver, groups=()):
+        old_receiver = self.receivers.get(name)
+        self.receivers[name] = receiver
+        self.names.setdefault(receiver, set()).add(name)
+        for group in groups:
+            self.groups.setdefault(group, set()).add(name)
+
+        if old_receiver is not None and old_receiver != receiver:
+            old_names = self.names[old_receiver]
+            old_names.discard(name)
+            if not old_names:
+                # That name was all the old receiver had.
+                del self.names[old_receiver]
+                self.unwatch(old_receiver)
+
+        if receiver not in self.watched:
+            self.watch(receiver)
+
+    def watch(self, receiver):
+        pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                pidfd = os.pidfd_open(receiver.pid)
+            except ProcessLookupError:
+                self.forget(receiver)
+                return
+            except OSError:
+                # The kernel doesn't support pidfds.
+                pass
+
+        # Check after opening the pidfd, so it can't be for some other
+        # process that got the receiver's pid.
+        if shtuff_process_has_terminated(*receiver):
+            if pidfd is not None:
+                os.close(pidfd)
+            self.forget(receiver)
+            return
+
+        self.watched[receiver] = pidfd
+        if pidfd is not None:
+            self.selector.register(
+                pidfd, selectors.EVENT_READ, lambda: self.forget(receiver)
+            )
+
+    def unwatch(self, receiver):
+        pidfd = self.watched.pop(receiver, None)
+        if pidfd is not None:
+            self.selector.unregister(pidfd)
+            os.close(pidfd)
+
+    def forget(self, receiver):
+        """
+        Forget everything about the given receiver, which has exited.
+        """
+        self.unwatch(receiver)
+        names = self.names.pop(receiver, set())
+        for name in names:
+            del self.receivers[name]
+        for group, members in list(self.groups.items()):
+            members.difference_update(names)
+            if not members:
+                del self.groups[group]
+
+        forget_receiver(receiver)
+
+    def run(self, server):
+        server.setblocking(False)
+        self.selector.register(
+            server, selectors.EVENT_READ, lambda: self.on_accept(server)
+        )
+        while True:
+            polling = None in self.watched.values()
+            events = self.selector.select(self.POLL_INTERVAL if polling else None)
+            for key, mask in events:
+                key.data()
+
+            if polling:
+                for receiver, pidfd in list(self.watched.items()):
+                    if pidfd is None and shtuff_process_has_terminated(*receiver):
+                        self.forget(receiver)
+
+    def on_accept(self, server):
+        try:
+            sock, _ = server.accept()
+        except BlockingIOError:
+            return
+
+        # Requests and replies are tiny, and come from processes on this
+        # machine that are waiting on us, so handle them right away.
+        with sock, sock.makefile("rb") as rfile:
+            sock.settimeout(BROKER_TIMEOUT)
+            try:
+                for request, body in read_messages(rfile):
+                    send_message(sock, self.handle(request))
+                    break
+            except (OSError, EOFError, ValueError, KeyError):
+                pass
+
+    def handle(self, request):
+        op = request["op"]
+        if op == "lookup":
+            return {"receiver": self.receivers.get(request["name"])}
+        elif op == "names":
+            receiver = Receiver(*request["receiver"])
+            names = self.names.get(receiver, set())
+            # Older versions of shtuff didn't record start times.
+            names = names | self.names.get(receiver._replace(start_time=None), set())
+            return {"names": sorted(names)}
+        elif op == "ls":
+            return {"receivers": self.receivers}
+        elif op == "group":
+            members = self.groups.get(request["group"], ())
+            return {"receivers": {name: self.receivers[name] for name in members}}
+        elif op == "register":
+            self.register(
+                request["name"], Receiver(*request["receiver"]), request["groups"]
+            )
+            return {}
+        elif op == "forget":
+            self.forget(Receiver(*request["receiver"]))
+            return {}
+        elif op == "ping":
+            return {}
+
+        raise ValueError(f"unknown op: {op}")
+
+
+def print_target_not_found(name):
+    print(f"Shtuff target {name} was not found.", file=sys.stderr)
+
+
+def shtuff_process_has_terminated(pid, start_time=None, slot=None):
+    with trace("check_receiver", receiver=pid):
+        if get_process_command(pid) != "shtuff":
+            return True
 
+        # The pid may have been reused by another shtuff since start_time.
+        if start_time is not None and get_process_start_time(pid) != start_time:
+            return True
 
-def shtuff_process_has_terminated(pid):
-    return get_process_command(pid) != "shtuff"
+        # A supervisor removes a slot's control socket once its shell exits.
+        return slot is not None and not os.path.exists(get_socket_file(pid, slot))
 
 
 if __name__ == "__main__":
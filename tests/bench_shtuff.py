@@ -0,0 +1,746 @@
+"""
+Benchmarks for shtuff's hot paths.
+
+These are not part of the unit test suite. Run them with `make bench`, or
+pick specific benchmarks by name:
+
+    $ python -m tests.bench_shtuff ancestry
+
+The benchmarks are:
+
+    ancestry    finding the nearest receiver by walking up the process tree,
+                and from SHTUFF_RECEIVER
+    startup     cold start of the CLI, compared to a bare `python`. Fails
+                if `shtuff into` is more than INTO_STARTUP_BUDGET slower
+    latency     from sending a command to seeing its output (percentiles)
+    throughput  commands per second a single receiver absorbs
+    interrupt   from `shtuff into --interrupt --cancel` to seeing its output,
+                while the shell floods the terminal and has a backlog of
+                commands (percentiles)
+    registry    registry lookups with 10, 1k and 10k registered receivers
+    memory      RSS of an idle receiver, standalone and supervised
+    zygote      time until 20 terminals opened at once with `shtuff new` all
+                have a prompt, with and without a zygote
+    relay       relaying a large amount of output, compared to pexpect
+    attach      relaying a large amount of output to 0, 1, 4 and 16 viewers
+    trace       the latency benchmark with SHTUFF_TRACE unset and set
+
+Every measurement is printed to stdout as one JSON object per line, so
+results from different commits can be compared with your JSON tool of
+choice. If any benchmark fails, the others still run, and we exit with an
+error at the end.
+"""
+
+import os
+import pty
+import sys
+import json
+import time
+import psutil
+import select
+import tempfile
+import threading
+import statistics
+import subprocess
+
+from contextlib import ExitStack, contextmanager
+
+import shtuff
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# How much slower than a bare `python -c pass` `shtuff into` may be.
+INTO_STARTUP_BUDGET = 0.15
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len("bench_") :]] = func
+    return func
+
+
+class BenchmarkFailed(Exception):
+    """
+    A benchmark measured something that's over budget.
+    """
+
+
+def report(benchmark, **fields):
+    print(json.dumps({"benchmark": benchmark, **fields}), flush=True)
+
+
+def time_calls(func, repeat):
+    """
+    Call func `repeat` times and return the individual wall times in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    return timings
+
+
+def percentiles(timings):
+    """
+    Summarize the given wall times in seconds as report() fields, in
+    milliseconds.
+    """
+    timings = sorted(timings)
+
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p / 100))] * 1000
+
+    return {
+        "repeat": len(timings),
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": timings[-1] * 1000,
+    }
+
+
+@contextmanager
+def private_data_dir():
+    """
+    Point shtuff (both in this process and in any processes we start) at an
+    empty data directory for the duration.
+    """
+    old_env = os.environ.get("XDG_DATA_HOME")
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["XDG_DATA_HOME"] = tmp
+        # pyxdg only looks at the environment when it's first imported.
+        shtuff._data_dir = os.path.join(tmp, "shtuff")
+        os.mkdir(shtuff._data_dir)
+        shtuff._registry_connections.__dict__.clear()
+        try:
+            yield tmp
+        finally:
+            if old_env is None:
+                del os.environ["XDG_DATA_HOME"]
+            else:
+                os.environ["XDG_DATA_HOME"] = old_env
+            shtuff._data_dir = None
+            shtuff._registry_connections.__dict__.clear()
+
+
+class BenchReceiver:
+    """
+    A receiver named `name` running sh on a pty, for benchmarks to stuff
+    commands into and watch the output of. If supervised, it runs in the
+    running supervisor, and pid is that of its thin client.
+    """
+
+    def __init__(self, name, supervised=False):
+        self.name = name
+        if supervised:
+            code = (
+                f"import shtuff; shtuff.attach_to_supervisor('sh', name={name!r}); "
+                "raise SystemExit('no supervisor')"
+            )
+        else:
+            code = f"import shtuff; shtuff.spawn_and_stuff('sh', name={name!r})"
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            os.environ["PS1"] = "$ "
+            os.chdir(REPO_ROOT)
+            os.execv(sys.executable, [sys.executable, "-c", code])
+
+        self.output = bytearray()
+        self.expect(b"$ ")
+        # The receiver registers itself right after starting the shell.
+        while shtuff.lookup_receiver(name) is None:
+            time.sleep(0.01)
+
+    def expect(self, marker, timeout=30):
+        """
+        Read output until marker shows up, and forget everything up to it.
+        """
+        deadline = time.monotonic() + timeout
+        while marker not in self.output:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                raise TimeoutError(f"never saw {marker!r}")
+
+            self.output += os.read(self.fd, 1024 * 1024)
+
+        del self.output[: self.output.index(marker) + len(marker)]
+
+    def close(self):
+        os.kill(self.pid, 9)
+        os.waitpid(self.pid, 0)
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def legacy_get_process_command(pid):
+    # This is how shtuff used to identify processes: by forking `ps`.
+    return (
+        subprocess.run(
+            f"ps -p {pid} -o command",
+            capture_output=True,
+            shell=True,
+        )
+        .stdout.decode()
+        .split("\n")[-2]
+        .strip()
+    )
+
+
+def legacy_find_nearest_shtuff_process():
+    def ppid(process):
+        parent = process.parent()
+        if parent is None or parent.pid == process.pid:
+            return None
+
+        if legacy_get_process_command(parent.pid) == "shtuff":
+            return parent.pid
+
+        return ppid(parent)
+
+    return ppid(psutil.Process())
+
+
+CHAIN_SCRIPT = """\
+if [ "$1" -gt 0 ]; then
+  sh "$0" $(($1 - 1)) "$2"
+  exit $?
+fi
+exec "{python}" -m tests.bench_shtuff "$2"
+"""
+
+
+def run_in_process_chain(depth, leaf_benchmark):
+    """
+    Run the given benchmark at the bottom of a chain of `depth` nested shells,
+    under a process titled "shtuff" that hands them a SHTUFF_RECEIVER token,
+    as a receiver would.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        chain = os.path.join(tmp, "chain.sh")
+        with open(chain, "w") as f:
+            f.write(CHAIN_SCRIPT.format(python=sys.executable))
+
+        root = (
+            "import os, sys, subprocess, setproctitle, shtuff; "
+            "setproctitle.setproctitle('shtuff'); "
+            "token = shtuff.receiver_token(shtuff.get_receiver(os.getpid())); "
+            "env = dict(os.environ, SHTUFF_RECEIVER=token); "
+            "sys.exit(subprocess.call(sys.argv[1:], env=env, start_new_session=True))"
+        )
+        subprocess.run(
+            [sys.executable, "-c", root, "sh", chain, str(depth), leaf_benchmark],
+            cwd=REPO_ROOT,
+            check=True,
+        )
+
+
+@benchmark
+def bench_ancestry():
+    for depth in (5, 20, 50):
+        run_in_process_chain(depth, "_ancestry_leaf")
+
+
+@benchmark
+def bench__ancestry_leaf():
+    # Our ancestors are: the chain of shells, then the "shtuff" root.
+    root = shtuff.find_nearest_shtuff_process()
+    depth = len(shtuff.get_ancestor_pids()) - len(shtuff.get_ancestor_pids(root)) - 1
+    implementations = {
+        "ps": (legacy_find_nearest_shtuff_process, 3),
+        "in-process": (shtuff.find_nearest_shtuff_process, 100),
+        "token": (lambda: shtuff.find_nearest_receiver().pid, 100),
+    }
+    for implementation, (func, repeat) in implementations.items():
+        assert func() == shtuff.find_nearest_shtuff_process()
+        timings = time_calls(func, repeat)
+        report(
+            "ancestry",
+            implementation=implementation,
+            depth=depth,
+            repeat=repeat,
+            median_ms=statistics.median(timings) * 1000,
+        )
+
+
+@benchmark
+def bench_startup():
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, XDG_DATA_HOME=tmp, PYTHONPATH=REPO_ROOT)
+        shtuff_cli = [sys.executable, "-c", "import shtuff; shtuff.main()"]
+        commands = {
+            "python": [sys.executable, "-c", "pass"],
+            "shtuff has": shtuff_cli + ["has", "nobody"],
+            "shtuff into": shtuff_cli + ["into", "nobody", "true"],
+            "shtuff ls": shtuff_cli + ["ls"],
+        }
+        medians = {}
+        for command, argv in commands.items():
+            timings = time_calls(
+                lambda: subprocess.run(argv, env=env, stderr=subprocess.DEVNULL),
+                repeat=20,
+            )
+            medians[command] = statistics.median(timings)
+            report(
+                "startup",
+                command=command,
+                repeat=20,
+                median_ms=medians[command] * 1000,
+            )
+
+        overhead = medians["shtuff into"] - medians["python"]
+        report(
+            "startup",
+            command="shtuff into",
+            overhead_ms=overhead * 1000,
+            budget_ms=INTO_STARTUP_BUDGET * 1000,
+            within_budget=overhead < INTO_STARTUP_BUDGET,
+        )
+        if overhead >= INTO_STARTUP_BUDGET:
+            raise BenchmarkFailed(
+                f"`shtuff into` takes {overhead * 1000:.0f}ms longer to start than"
+                f" a bare python, over the budget of {INTO_STARTUP_BUDGET * 1000:.0f}ms"
+            )
+
+
+def measure_latency(benchmark, trace_file=None, **fields):
+    """
+    Report how long it takes from sending a command to a fresh receiver until
+    its output shows up in the receiver's terminal, both through the CLI
+    (which includes its startup time) and through stuff_into() directly. If
+    trace_file is given, the sender and the receiver both trace into it.
+    """
+    if trace_file is not None:
+        os.environ["SHTUFF_TRACE"] = trace_file
+    shtuff.start_tracing()
+    try:
+        with BenchReceiver("bench") as receiver:
+            receiver_id = shtuff.lookup_receiver("bench")
+            argv = [sys.executable, "-c", "import shtuff; shtuff.main()"]
+            argv += ["into", "bench"]
+            senders = {
+                "cli": (
+                    lambda cmd: subprocess.run(argv + [cmd], cwd=REPO_ROOT, check=True),
+                    50,
+                ),
+                "in-process": (
+                    lambda cmd: shtuff.stuff_into(receiver_id, (cmd + "\n").encode()),
+                    500,
+                ),
+            }
+            for sender, (send, repeat) in senders.items():
+                timings = []
+                for i in range(repeat):
+                    # Quote the marker so it doesn't show up in the echoed
+                    # command, only in its output.
+                    start = time.perf_counter()
+                    send(f"echo mark''er-{i}")
+                    receiver.expect(f"marker-{i}\r\n".encode())
+                    timings.append(time.perf_counter() - start)
+
+                report(benchmark, **fields, sender=sender, **percentiles(timings))
+    finally:
+        os.environ.pop("SHTUFF_TRACE", None)
+        shtuff.start_tracing()
+
+
+@benchmark
+def bench_latency():
+    with private_data_dir():
+        measure_latency("latency")
+
+
+@benchmark
+def bench_trace():
+    # What tracing costs a send, both when it's off (which should be
+    # nothing) and when it's on (for the sender and the receiver both).
+    with private_data_dir() as tmp:
+        for tracing in (False, True):
+            trace_file = os.path.join(tmp, "trace") if tracing else None
+            measure_latency("trace", trace_file, tracing=tracing)
+
+
+@benchmark
+def bench_throughput():
+    # How many commands per second a single receiver can absorb when
+    # senders don't wait for each other, sending one command at a time
+    # (through stuff_into(), or a Client that keeps its connection open), or
+    # in batches.
+    count = 2000
+    batch_size = 100
+    with private_data_dir(), BenchReceiver("bench") as receiver:
+        receiver_id = shtuff.lookup_receiver("bench")
+        client = shtuff.Client()
+        senders = {
+            "stuff_into": lambda: shtuff.stuff_into(receiver_id, b":\n"),
+            "client": lambda: client.send("bench", ":"),
+            "client batch": lambda: client.send_batch("bench", [":"] * batch_size),
+        }
+        for sender, send in senders.items():
+            sends = count // batch_size if sender == "client batch" else count
+            start = time.perf_counter()
+            for _ in range(sends):
+                send()
+                # Don't let the shell's echo back up and stall the receiver.
+                if select.select([receiver.fd], [], [], 0)[0]:
+                    receiver.output += os.read(receiver.fd, 1024 * 1024)
+                    del receiver.output[:-64]
+            client.send("bench", "echo d''one")
+            receiver.expect(b"done\r\n")
+            elapsed = time.perf_counter() - start
+
+            report(
+                "throughput",
+                sender=sender,
+                commands=count,
+                commands_per_s=count / elapsed,
+            )
+
+        client.close()
+
+
+@benchmark
+def bench_interrupt():
+    with private_data_dir(), BenchReceiver("bench") as receiver:
+        receiver_id = shtuff.lookup_receiver("bench")
+        priority = shtuff.get_priority_options(interrupt=True, cancel=True)
+        timings = []
+        for i in range(20):
+            # Keep the shell busy printing, and pile up a command behind
+            # that it would otherwise get to once it's done.
+            shtuff.stuff_into(receiver_id, b"yes\n")
+            backlog = threading.Thread(
+                target=shtuff.stuff_into,
+                args=(receiver_id, b": " + b"x" * 1024 * 1024 + b"\n"),
+            )
+            backlog.start()
+            deadline = time.monotonic() + 0.2
+            while time.monotonic() < deadline:
+                select.select([receiver.fd], [], [], 0.01)
+                os.read(receiver.fd, 1024 * 1024)
+
+            start = time.perf_counter()
+            shtuff.stuff_into(
+                receiver_id, f"echo mark''er-{i}\n".encode(), None, None, priority
+            )
+            # Don't hold on to everything `yes` printed.
+            marker = f"marker-{i}\r\n".encode()
+            while marker not in receiver.output:
+                select.select([receiver.fd], [], [], 10)
+                receiver.output = receiver.output[-len(marker) :]
+                receiver.output += os.read(receiver.fd, 1024 * 1024)
+            timings.append(time.perf_counter() - start)
+            receiver.expect(marker)
+            backlog.join()
+
+        report("interrupt", **percentiles(timings))
+
+
+@benchmark
+def bench_registry():
+    # How the registry lookups on the hot paths (`shtuff into`, `shtuff
+    # whoami`, `shtuff ls`) scale with the number of registered receivers.
+    for size in (10, 1000, 10000):
+        with private_data_dir():
+            # Made up receivers that are (almost certainly) not running.
+            receivers = [shtuff.Receiver(4_000_000 + i, i) for i in range(size)]
+            with shtuff.registry_transaction() as registry:
+                registry.executemany(
+                    "INSERT INTO receivers (name, pid, start_time) VALUES (?, ?, ?)",
+                    [(f"receiver-{i}", *r) for i, r in enumerate(receivers)],
+                )
+                registry.executemany(
+                    "INSERT INTO groups (grp, name) VALUES (?, ?)",
+                    [(f"group-{i % 10}", f"receiver-{i}") for i in range(size)],
+                )
+
+            middle = size // 2
+            operations = {
+                "lookup_receiver": lambda: shtuff.lookup_receiver(f"receiver-{middle}"),
+                "get_names_for_receiver": lambda: shtuff.get_names_for_receiver(
+                    receivers[middle]
+                ),
+                "get_group_members": lambda: shtuff.get_group_members("group-0"),
+                "read_registry": shtuff.read_registry,
+            }
+            for operation, func in operations.items():
+                timings = time_calls(func, repeat=100)
+                report(
+                    "registry",
+                    operation=operation,
+                    entries=size,
+                    repeat=100,
+                    median_ms=statistics.median(timings) * 1000,
+                )
+
+            # This forgets every one of them, so it only gets to run once.
+            start = time.perf_counter()
+            shtuff.prune_registry()
+            report(
+                "registry",
+                operation="prune_registry",
+                entries=size,
+                repeat=1,
+                median_ms=(time.perf_counter() - start) * 1000,
+            )
+
+
+@contextmanager
+def bench_daemon(action):
+    """
+    Run `shtuff <action>` (a supervisor, say) in the current data directory
+    for the duration.
+    """
+    daemon = subprocess.Popen(
+        [sys.executable, "-c", "import shtuff; shtuff.main()", action],
+        cwd=REPO_ROOT,
+    )
+    try:
+        while not os.path.exists(shtuff.data_dir(f"{action}.sock")):
+            time.sleep(0.01)
+        yield daemon
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def rss_mb(pid):
+    return psutil.Process(pid).memory_info().rss / 1024 / 1024
+
+
+@benchmark
+def bench_memory():
+    # What an idle receiver costs, not counting the shell it runs.
+    with private_data_dir(), BenchReceiver("bench") as receiver:
+        process = psutil.Process(receiver.pid)
+        report(
+            "memory",
+            mode="standalone",
+            rss_mb=process.memory_info().rss / 1024 / 1024,
+            child_rss_mb=sum(
+                child.memory_info().rss for child in process.children(recursive=True)
+            )
+            / 1024
+            / 1024,
+        )
+
+    # With a supervisor, each receiver costs a thin client, plus its share
+    # of the supervisor.
+    count = 10
+    with private_data_dir(), bench_daemon("supervisor") as supervisor:
+        receivers = [BenchReceiver(f"bench-{i}", supervised=True) for i in range(count)]
+        try:
+            supervisor_mb = rss_mb(supervisor.pid)
+            client_mb = statistics.mean(rss_mb(r.pid) for r in receivers)
+            report(
+                "memory",
+                mode="supervised",
+                receivers=count,
+                supervisor_rss_mb=supervisor_mb,
+                client_rss_mb=client_mb,
+                rss_mb=client_mb + supervisor_mb / count,
+            )
+        finally:
+            for receiver in receivers:
+                receiver.close()
+
+
+def open_terminals(count, cmd):
+    """
+    Run `shtuff new cmd` on `count` new ptys at once. Returns a list of
+    (pid, fd) tuples.
+    """
+    terminals = []
+    for _ in range(count):
+        pid, fd = pty.fork()
+        if pid == 0:
+            os.environ["SHELL"] = "sh"
+            os.environ["PS1"] = "$ "
+            os.chdir(REPO_ROOT)
+            argv = [sys.executable, "-c", "import shtuff; shtuff.main()", "new", cmd]
+            os.execv(sys.executable, argv)
+        terminals.append((pid, fd))
+
+    return terminals
+
+
+@benchmark
+def bench_zygote():
+    count = 20
+    for mode in ["standalone", "zygote"]:
+        with private_data_dir(), ExitStack() as stack:
+            if mode == "zygote":
+                stack.enter_context(bench_daemon("zygote"))
+
+            start = time.perf_counter()
+            terminals = open_terminals(count, "echo RE''ADY")
+            outputs = {fd: bytearray() for pid, fd in terminals}
+            ready = []
+            while outputs:
+                for fd in select.select(list(outputs), [], [], 30)[0]:
+                    outputs[fd] += os.read(fd, 64 * 1024)
+                    if b"READY" in outputs[fd]:
+                        ready.append(time.perf_counter() - start)
+                        del outputs[fd]
+
+            report("zygote", mode=mode, terminals=count, **percentiles(ready))
+
+            for pid, fd in terminals:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+                os.close(fd)
+
+
+RELAY_RECEIVERS = {
+    "pexpect": ("import pexpect; p = pexpect.spawn(sys.argv[1]); p.interact()"),
+    "relay": "shtuff.spawn_and_stuff(sys.argv[1])",
+}
+
+RELAY_RECEIVER_TEMPLATE = """\
+import sys, json, resource, shtuff
+{receiver}
+usage = resource.getrusage(resource.RUSAGE_SELF)
+with open(sys.argv[2], "w") as f:
+    json.dump(usage.ru_utime + usage.ru_stime, f)
+"""
+
+
+def write_payload(path, size):
+    with open(path, "wb") as f:
+        line = b"x" * 99 + b"\n"
+        f.write(line * (size // len(line)))
+
+
+def run_relay_receiver(receiver, command, tmp):
+    """
+    Run the given receiver code on a pty, have it run command, and read
+    everything it relays until it exits. Return how many bytes it relayed,
+    how long that took, and how much CPU time the receiver used.
+    """
+    cpu_file = os.path.join(tmp, "cpu.json")
+    code = RELAY_RECEIVER_TEMPLATE.format(receiver=receiver)
+
+    start = time.perf_counter()
+    pid, fd = pty.fork()
+    if pid == 0:
+        os.environ["XDG_DATA_HOME"] = tmp
+        os.execv(sys.executable, [sys.executable, "-c", code, command, cpu_file])
+
+    relayed = 0
+    while True:
+        try:
+            data = os.read(fd, 1024 * 1024)
+        except OSError:
+            break
+        if not data:
+            break
+        relayed += len(data)
+    os.waitpid(pid, 0)
+    os.close(fd)
+    elapsed = time.perf_counter() - start
+
+    with open(cpu_file) as f:
+        return relayed, elapsed, json.load(f)
+
+
+@benchmark
+def bench_relay():
+    with tempfile.TemporaryDirectory() as tmp:
+        payload = os.path.join(tmp, "payload")
+        write_payload(payload, 50 * 1024 * 1024)
+
+        for implementation, receiver in RELAY_RECEIVERS.items():
+            relayed, elapsed, cpu = run_relay_receiver(receiver, f"cat {payload}", tmp)
+            megabytes = relayed / 1024 / 1024
+            report(
+                "relay",
+                implementation=implementation,
+                megabytes=megabytes,
+                mb_per_s=megabytes / elapsed,
+                cpu_ms_per_mb=cpu * 1000 / megabytes,
+            )
+
+
+def view(sock, received):
+    with sock:
+        buf = bytearray(1024 * 1024)
+        while True:
+            n = sock.recv_into(buf)
+            if not n:
+                break
+            received.append(n)
+
+
+@benchmark
+def bench_attach():
+    with private_data_dir() as tmp:
+        payload = os.path.join(tmp, "payload")
+        write_payload(payload, 20 * 1024 * 1024)
+        go = os.path.join(tmp, "go")
+        # Hold off on printing anything until all the viewers are attached.
+        command = f"sh -c 'while [ ! -e {go} ]; do sleep 0.01; done; cat {payload}'"
+        receiver = 'shtuff.spawn_and_stuff(sys.argv[1], name="bench")'
+
+        for viewers in (0, 1, 4, 16):
+            if os.path.exists(go):
+                os.remove(go)
+            threads = []
+            received = []
+
+            def attach_viewers():
+                # The previous round's receiver may still be registered.
+                target = None
+                while target is None or shtuff.shtuff_process_has_terminated(*target):
+                    time.sleep(0.01)
+                    target = shtuff.lookup_receiver("bench")
+                for _ in range(viewers):
+                    sock = shtuff.connect_to_receiver(target.pid, target.slot)
+                    shtuff.send_message(sock, {"op": "attach"})
+                    thread = threading.Thread(target=view, args=(sock, received))
+                    thread.start()
+                    threads.append(thread)
+                # Make sure the last viewer has been heard from.
+                shtuff.get_receiver_stats(target)
+                open(go, "w").close()
+
+            attacher = threading.Thread(target=attach_viewers)
+            attacher.start()
+            relayed, elapsed, cpu = run_relay_receiver(receiver, command, tmp)
+            attacher.join()
+            for thread in threads:
+                thread.join()
+
+            megabytes = relayed / 1024 / 1024
+            report(
+                "attach",
+                viewers=viewers,
+                megabytes=megabytes,
+                viewer_megabytes=sum(received) / 1024 / 1024,
+                mb_per_s=megabytes / elapsed,
+                cpu_ms_per_mb=cpu * 1000 / megabytes,
+            )
+
+
+def main():
+    names = sys.argv[1:] or [name for name in BENCHMARKS if not name.startswith("_")]
+    failed = False
+    for name in names:
+        try:
+            BENCHMARKS[name]()
+        except BenchmarkFailed as e:
+            print(f"Error: {name}: {e}", file=sys.stderr)
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,21 @@
 import os
+import json
+import asyncio
 import shutil
+import socket
+import sqlite3
+import signal
 import pexpect
+import time
 import unittest
 import subprocess
 
+from textwrap import dedent
+from unittest import mock
+
+import shtuff
+from shtuff import RingBuffer
+
 SHTUFF = 'python -c "import shtuff; shtuff.main()"'
 
 
@@ -27,6 +39,11 @@ class TestShtuff(unittest.TestCase):
         if os.path.exists(os.environ["XDG_DATA_HOME"]):
             shutil.rmtree(os.environ["XDG_DATA_HOME"])
 
+        # Forget the data directory (and the registry in it) that we just
+        # deleted.
+        shtuff._data_dir = None
+        shtuff._registry_connections.__dict__.clear()
+
     def test_shtuff_new(self):
         child = pexpect.spawn(f"{SHTUFF} new 'echo foo\nexit'")
         child.expect("foo")
@@ -38,6 +55,726 @@ class TestShtuff(unittest.TestCase):
         subprocess.run(f"{SHTUFF} into receiver 'echo foo'", shell=True, check=True)
         receiver.expect("foo")
 
+    def test_shtuff_into_uses_control_socket(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        subprocess.run(f"{SHTUFF} into receiver 'echo foo'", shell=True, check=True)
+        receiver.expect("foo")
+
+        data_dir = os.path.join(os.environ["XDG_DATA_HOME"], "shtuff")
+        self.assertIn(f"{receiver.pid}.sock", os.listdir(data_dir))
+        self.assertNotIn(f"{receiver.pid}.command", os.listdir(data_dir))
+
+    def test_shtuff_into_without_socket_does_not_lose_concurrent_commands(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        # Force senders onto the spool + SIGUSR1 fallback.
+        data_dir = os.path.join(os.environ["XDG_DATA_HOME"], "shtuff")
+        os.unlink(os.path.join(data_dir, f"{receiver.pid}.sock"))
+
+        out = os.path.join(os.environ["HOME"], "concurrent.txt")
+        if os.path.exists(out):
+            os.unlink(out)
+
+        senders = [
+            subprocess.Popen(f"{SHTUFF} into receiver 'echo {i} >> {out}'", shell=True)
+            for i in range(20)
+        ]
+        for sender in senders:
+            self.assertEqual(sender.wait(), 0)
+
+        deadline = time.monotonic() + 30
+        lines = []
+        while len(lines) < 20 and time.monotonic() < deadline:
+            receiver.expect([pexpect.TIMEOUT, "\\$"], timeout=0.1)
+            if os.path.exists(out):
+                with open(out) as f:
+                    lines = f.read().split()
+
+        self.assertEqual(sorted(lines, key=int), [str(i) for i in range(20)])
+
+    def test_shtuff_into_does_not_import_receiver_modules(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        cp = subprocess.run(
+            f"python -X importtime -c 'import shtuff; shtuff.main()' into receiver 'echo foo'",
+            shell=True,
+            check=True,
+            stderr=subprocess.PIPE,
+            encoding="utf-8",
+        )
+        receiver.expect("foo")
+
+        imported = {line.split("|")[-1].strip() for line in cp.stderr.splitlines()}
+        for module in ["pexpect", "psutil", "setproctitle", "importlib.metadata"]:
+            self.assertNotIn(module, imported)
+
+    def test_shtuff_into_streams_stdin(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        out = os.path.join(os.environ["HOME"], "streamed.txt")
+        receiver.sendline(f"stty -echo; cat > {out}")
+
+        payload = "".join(f"line {i} {'x' * 80}\n" for i in range(20000)).encode()
+        sender = subprocess.Popen(
+            f"{SHTUFF} into receiver -", shell=True, stdin=subprocess.PIPE
+        )
+        sender.stdin.write(payload)
+        sender.stdin.close()
+        while sender.poll() is None:
+            # Keep draining the receiver's output so it never blocks on us.
+            receiver.expect([pexpect.TIMEOUT, pexpect.EOF], timeout=0.1)
+        self.assertEqual(sender.returncode, 0)
+
+        # End cat's input.
+        subprocess.run(
+            f"{SHTUFF} into -n receiver \"$(printf '\\004')\"", shell=True, check=True
+        )
+        receiver.expect("\\$")
+
+        with open(out, "rb") as f:
+            self.assertEqual(f.read(), payload)
+
+    def test_shtuff_into_wait_until_quiet(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        result = subprocess.run(
+            f"{SHTUFF} into --wait --quiet 1 receiver 'sleep 0.5; echo done'",
+            shell=True,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        self.assertGreaterEqual(float(result.stdout), 0.5)
+        receiver.expect("done")
+
+    def test_shtuff_into_wait_for_prompt(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        result = subprocess.run(
+            f"{SHTUFF} into --wait --prompt '\\$ $' receiver 'sleep 0.5'",
+            shell=True,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        self.assertGreaterEqual(float(result.stdout), 0.5)
+
+    def test_shtuff_into_ack(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        result = subprocess.run(
+            f"{SHTUFF} into --ack receiver 'echo f\"\"oo'",
+            shell=True,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.stdout, "")
+        receiver.expect("foo")
+
+    def test_shtuff_into_wait_timeout(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        result = subprocess.run(
+            f"{SHTUFF} into --wait --timeout 0.5 receiver 'sleep 0.2; echo tick; sleep 0.2; echo tick; sleep 0.2; echo tick'",
+            shell=True,
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("Timed out waiting for receiver.", result.stderr)
+
+    def test_shtuff_into_defer(self):
+        subprocess.run(
+            f"{SHTUFF} into --defer receiver 'echo f\"\"irst'", shell=True, check=True
+        )
+        subprocess.run(
+            f"{SHTUFF} into --defer receiver 'echo s\"\"econd'", shell=True, check=True
+        )
+
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("first")
+        receiver.expect("second")
+
+        # Once the receiver is around, --defer makes no difference.
+        subprocess.run(
+            f"{SHTUFF} into --defer receiver 'echo t\"\"hird'", shell=True, check=True
+        )
+        receiver.expect("third")
+
+    def test_shtuff_into_defer_to_alias(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        subprocess.run(
+            f"{SHTUFF} into --defer alias 'echo f\"\"oo'", shell=True, check=True
+        )
+
+        receiver.sendline(f"{SHTUFF} as alias")
+        receiver.expect("foo")
+
+    def test_shtuff_into_defer_expires(self):
+        subprocess.run(
+            f"{SHTUFF} into --defer --ttl 0.1 receiver 'echo e\"\"xpired'",
+            shell=True,
+            check=True,
+        )
+        time.sleep(0.2)
+
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        subprocess.run(
+            f"{SHTUFF} into receiver 'echo f\"\"resh'", shell=True, check=True
+        )
+        receiver.expect("fresh")
+        self.assertNotIn(b"expired", receiver.before)
+
+    def test_spool_priority(self):
+        pid = os.getpid()
+        os.mkdir(shtuff.get_spool_dir(pid))
+        shtuff.spool_command(pid, b"second")
+        priority = shtuff.get_priority_options(interrupt=True)
+        shtuff.spool_command(pid, b"first", priority)
+
+        self.assertEqual(
+            [(data, priority) for data, _, priority in shtuff.drain_spool(pid)],
+            [(b"first", {"interrupt": True, "cancel": False}), (b"second", None)],
+        )
+
+    def test_shtuff_into_interrupt(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        receiver.sendline("sleep 30; echo n''ope")
+        time.sleep(0.2)
+
+        start = time.monotonic()
+        subprocess.run(
+            f"{SHTUFF} into --interrupt receiver 'echo b\"\"ack'",
+            shell=True,
+            check=True,
+        )
+        receiver.expect("back", timeout=5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertNotIn(b"nope", receiver.before)
+
+    def test_shtuff_into_defer_needs_a_positive_ttl(self):
+        for ttl in ["0", "-1", "nan"]:
+            cp = subprocess.run(
+                f"{SHTUFF} into --defer --ttl={ttl} nobody x",
+                shell=True,
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(cp.returncode, 2)
+            self.assertIn("--ttl: must be more than 0", cp.stderr)
+
+    def test_shtuff_into_needs_a_command(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        cp = subprocess.run(
+            f"{SHTUFF} into receiver", shell=True, capture_output=True, text=True
+        )
+        self.assertEqual(cp.returncode, 1)
+        self.assertIn("a command is needed", cp.stderr)
+
+        # Unless there's nothing to do but interrupt.
+        subprocess.run(f"{SHTUFF} into --cancel receiver", shell=True, check=True)
+
+    def test_shtuff_trace(self):
+        trace_file = os.path.join(os.environ["HOME"], "trace")
+        if os.path.exists(trace_file):
+            os.unlink(trace_file)
+        env = dict(os.environ, SHTUFF_TRACE=trace_file)
+
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver", env=env)
+        receiver.expect("\\$")
+        subprocess.run(
+            f"{SHTUFF} into --ack receiver 'echo foo'", shell=True, check=True, env=env
+        )
+        receiver.expect("foo")
+
+        # Without SHTUFF_TRACE, nothing gets traced.
+        subprocess.run(f"{SHTUFF} into receiver 'echo bar'", shell=True, check=True)
+        receiver.expect("bar")
+        receiver.sendline("exit")
+        receiver.expect(pexpect.EOF)
+
+        with open(trace_file) as f:
+            spans = [json.loads(line) for line in f]
+
+        sender_spans = [span for span in spans if span["pid"] != receiver.pid]
+        (trace_id,) = {span["trace"] for span in sender_spans}
+        self.assertLessEqual(
+            {"startup", "parse_args", "lookup_receiver", "check_receiver", "connect"}
+            | {"send", "reply", "shtuff_into"},
+            {span["span"] for span in sender_spans},
+        )
+
+        # The receiver's span for the command matches up with the sender's.
+        (received,) = [
+            span
+            for span in spans
+            if span["span"] == "receive" and span["trace"] == trace_id
+        ]
+        self.assertEqual(received["pid"], receiver.pid)
+        self.assertEqual(received["written"], len(b"echo foo\n"))
+        (sent,) = [span for span in sender_spans if span["span"] == "send"]
+        self.assertLessEqual(sent["start"], received["start"])
+
+    def test_shtuff_batch(self):
+        receiver_a = pexpect.spawn(f"{SHTUFF} as receiver-a")
+        receiver_a.expect("\\$")
+        receiver_b = pexpect.spawn(f"{SHTUFF} as receiver-b")
+        receiver_b.expect("\\$")
+
+        manifest = dedent("""\
+            # Set up both shells.
+            receiver-a echo a''1
+            receiver-b echo b''1
+
+            receiver-a sleep 0.5; echo a''2
+            receiver-a @wait 1
+            receiver-a echo a''3
+            receiver-b @sleep 0.1
+            receiver-b echo b''2
+        """)
+        start = time.monotonic()
+        result = subprocess.run(
+            f"{SHTUFF} batch",
+            shell=True,
+            check=True,
+            input=manifest,
+            capture_output=True,
+            text=True,
+        )
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+        self.assertEqual(
+            result.stdout,
+            "Stuffed 3 commands into receiver-a.\nStuffed 2 commands into receiver-b.\n",
+        )
+
+        receiver_a.expect("a1")
+        receiver_a.expect("a2")
+        receiver_a.expect("a3")
+        receiver_b.expect("b1")
+        receiver_b.expect("b2")
+
+    def test_shtuff_batch_checks_every_target_first(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        result = subprocess.run(
+            f"{SHTUFF} batch",
+            shell=True,
+            input="receiver echo f''oo\nnobody echo bar\n",
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("Shtuff target nobody was not found.", result.stderr)
+
+        receiver.sendline("echo b''ar")
+        receiver.expect("bar")
+        self.assertNotIn(b"foo", receiver.before)
+
+    def test_shtuff_batch_rejects_bad_manifest(self):
+        result = subprocess.run(
+            f"{SHTUFF} batch",
+            shell=True,
+            input="receiver @wait\n",
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("line 1: @wait has to come after a command", result.stderr)
+
+    def test_shtuff_batch_checks_directive_arguments(self):
+        for manifest, error in [
+            ("receiver @sleep\n", "line 1: @sleep requires a duration"),
+            ("receiver @sleep 1 2\n", "line 1: @sleep requires a duration"),
+            (
+                "receiver @sleep soon\n",
+                "line 1: @sleep takes a duration in seconds, not soon",
+            ),
+            (
+                "receiver ls\nreceiver @wait 1 2\n",
+                "line 2: @wait takes at most one duration",
+            ),
+            (
+                "receiver ls\nreceiver @wait later\n",
+                "line 2: @wait takes a duration in seconds, not later",
+            ),
+        ]:
+            result = subprocess.run(
+                f"{SHTUFF} batch",
+                shell=True,
+                input=manifest,
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(result.returncode, 1)
+            self.assertIn(error, result.stderr)
+            self.assertNotIn("unpack", result.stderr)
+
+    def test_shtuff_tail(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        subprocess.run(f"{SHTUFF} into receiver \"echo f''oo\"", shell=True, check=True)
+        receiver.expect("foo")
+        receiver.expect("\\$")
+
+        cp = subprocess.run(
+            f"{SHTUFF} tail receiver", shell=True, check=True, stdout=subprocess.PIPE
+        )
+        self.assertIn(b"foo\r\n", cp.stdout)
+        self.assertTrue(cp.stdout.endswith(b"$ "))
+
+        cp = subprocess.run(
+            f"{SHTUFF} tail -n 2 receiver",
+            shell=True,
+            check=True,
+            stdout=subprocess.PIPE,
+        )
+        self.assertEqual(cp.stdout, b"$ ")
+
+    def test_shtuff_tail_follow(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        follower = pexpect.spawn(f"{SHTUFF} tail --follow receiver")
+        subprocess.run(f"{SHTUFF} into receiver \"echo b''ar\"", shell=True, check=True)
+        follower.expect("bar")
+
+        subprocess.run(f"{SHTUFF} into receiver exit", shell=True, check=True)
+        follower.expect(pexpect.EOF)
+
+    def test_shtuff_attach(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        receiver.sendline("echo f''oo")
+        receiver.expect("foo")
+
+        viewers = [pexpect.spawn(f"{SHTUFF} attach receiver") for _ in range(2)]
+        for viewer in viewers:
+            # Everybody gets what was printed before they showed up.
+            viewer.expect("foo")
+
+        # Nothing typed into a viewer goes to the shell.
+        viewers[0].sendline("echo n''ope")
+        subprocess.run(f"{SHTUFF} into receiver \"echo b''ar\"", shell=True, check=True)
+        for viewer in viewers:
+            viewer.expect("bar")
+        receiver.expect("bar")
+        self.assertNotIn(b"nope", receiver.before)
+
+        subprocess.run(f"{SHTUFF} into receiver exit", shell=True, check=True)
+        for viewer in viewers:
+            viewer.expect(pexpect.EOF)
+
+    def test_shtuff_attach_skips_slow_viewers_ahead(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver", searchwindowsize=100)
+        receiver.expect("\\$")
+
+        # A viewer that never reads anything.
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(
+            os.path.join(os.environ["XDG_DATA_HOME"], "shtuff", f"{receiver.pid}.sock")
+        )
+        shtuff.send_message(sock, {"op": "attach"})
+
+        # It doesn't hold up the shell...
+        size = 4 * shtuff.Relay.MAX_PENDING_FOLLOW
+        receiver.sendline(f"head -c {size} /dev/zero | tr '\\0' x; echo d''one")
+        receiver.expect("done", timeout=30)
+
+        # ...it just misses some of what the shell printed.
+        sock.settimeout(10)
+        with sock, sock.makefile("rb") as rfile:
+            received = 0
+            for header, body in shtuff.read_messages(rfile):
+                if header["op"] == "skipped":
+                    break
+                received += len(body)
+            self.assertGreater(header["size"], 0)
+            self.assertLess(received, size)
+
+    def test_shtuff_stats(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        for _ in range(2):
+            subprocess.run(
+                f"{SHTUFF} into --ack receiver 'echo foo'", shell=True, check=True
+            )
+
+        result = subprocess.run(
+            f"{SHTUFF} stats --json receiver",
+            shell=True,
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        stats = json.loads(result.stdout)
+        self.assertEqual(stats["name"], "receiver")
+        self.assertEqual(stats["commands"], 2)
+        self.assertEqual(stats["bytes_stuffed"], 2 * len("echo foo\n"))
+        self.assertGreater(stats["bytes_output"], 0)
+        self.assertEqual(stats["failed_deliveries"], 0)
+        self.assertEqual(sum(stats["latency_histogram"]), 2)
+
+    def test_shtuff_stats_for_all_receivers(self):
+        receiver_a = pexpect.spawn(f"{SHTUFF} as receiver-a")
+        receiver_a.expect("\\$")
+        receiver_b = pexpect.spawn(f"{SHTUFF} as receiver-b")
+        receiver_b.expect("\\$")
+
+        result = subprocess.run(
+            f"{SHTUFF} stats", shell=True, check=True, capture_output=True, text=True
+        )
+        header, *rows = result.stdout.splitlines()
+        self.assertTrue(header.startswith("NAME\tPID\t"))
+        self.assertEqual(
+            [row.split("\t")[:2] for row in rows],
+            [
+                ["receiver-a", str(receiver_a.pid)],
+                ["receiver-b", str(receiver_b.pid)],
+            ],
+        )
+
+    def start_daemon(self, action):
+        """
+        Run `shtuff <action>` (a broker, say) for the rest of the test.
+        """
+        daemon = subprocess.Popen(f"exec {SHTUFF} {action}", shell=True)
+        self.addCleanup(daemon.wait)
+        self.addCleanup(daemon.terminate)
+
+        socket_file = os.path.join(os.environ["XDG_DATA_HOME"], f"shtuff/{action}.sock")
+        deadline = time.monotonic() + 10
+        while not os.path.exists(socket_file):
+            self.assertLess(time.monotonic(), deadline, f"{action} never started")
+            time.sleep(0.05)
+
+        return daemon
+
+    def test_shtuff_broker(self):
+        self.start_daemon("broker")
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver --group workers")
+        receiver.expect("\\$")
+
+        subprocess.run(f"{SHTUFF} has receiver", shell=True, check=True)
+        subprocess.run(
+            f"{SHTUFF} into --group workers 'echo f\"\"oo'", shell=True, check=True
+        )
+        receiver.expect("foo")
+
+        receiver.sendline(f"{SHTUFF} whoami | tr a-z A-Z")
+        receiver.expect("RECEIVER")
+
+        # The broker forgets the receiver as soon as it exits, without
+        # anybody having to check on it.
+        receiver.sendline("exit")
+        receiver.expect(pexpect.EOF)
+        registry = os.path.join(os.environ["XDG_DATA_HOME"], "shtuff/registry.sqlite3")
+        deadline = time.monotonic() + 5
+        while True:
+            with sqlite3.connect(registry) as db:
+                rows = db.execute("SELECT name FROM receivers").fetchall()
+            if not rows:
+                break
+            self.assertLess(time.monotonic(), deadline, rows)
+            time.sleep(0.05)
+
+        result = subprocess.run(f"{SHTUFF} has receiver", shell=True)
+        self.assertEqual(result.returncode, 1)
+
+    def test_shtuff_broker_misses_fall_back_to_the_registry(self):
+        self.start_daemon("broker")
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        # Registered behind the broker's back.
+        registry = os.path.join(os.environ["XDG_DATA_HOME"], "shtuff/registry.sqlite3")
+        with sqlite3.connect(registry) as db:
+            db.execute(
+                "INSERT INTO receivers (name, pid, start_time, slot)"
+                " SELECT 'other', pid, start_time, slot FROM receivers"
+                " WHERE name = 'receiver'"
+            )
+
+        subprocess.run(f"{SHTUFF} has other", shell=True, check=True)
+        subprocess.run(f"{SHTUFF} into other 'echo f\"\"oo'", shell=True, check=True)
+        receiver.expect("foo")
+
+    def test_shtuff_broker_picks_up_existing_receivers(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        self.start_daemon("broker")
+
+        result = subprocess.run(
+            f"{SHTUFF} ls", shell=True, check=True, capture_output=True, text=True
+        )
+        self.assertEqual(result.stdout, f"receiver\t{receiver.pid}\n")
+
+    def test_shtuff_broker_only_runs_once(self):
+        self.start_daemon("broker")
+        result = subprocess.run(
+            f"{SHTUFF} broker", shell=True, capture_output=True, text=True
+        )
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("already running", result.stderr)
+
+    def test_shtuff_supervisor(self):
+        supervisor = self.start_daemon("supervisor")
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver --supervised")
+        receiver.expect("\\$")
+        other = pexpect.spawn(f"{SHTUFF} as other --supervised")
+        other.expect("\\$")
+
+        # Both shells live in the supervisor.
+        result = subprocess.run(
+            f"{SHTUFF} ls", shell=True, check=True, capture_output=True, text=True
+        )
+        self.assertEqual(
+            result.stdout, f"other\t{supervisor.pid}\nreceiver\t{supervisor.pid}\n"
+        )
+
+        subprocess.run(f"{SHTUFF} into receiver 'echo f\"\"oo'", shell=True, check=True)
+        receiver.expect("foo")
+        subprocess.run(f"{SHTUFF} into other 'echo b\"\"ar'", shell=True, check=True)
+        other.expect("bar")
+
+        receiver.sendline(f"{SHTUFF} whoami | tr a-z A-Z")
+        receiver.expect("RECEIVER")
+
+        # The terminal gets the shell's exit status, and the shell's name is
+        # forgotten.
+        receiver.sendline("exit 3")
+        receiver.expect(pexpect.EOF)
+        receiver.close()
+        self.assertEqual(receiver.exitstatus, 3)
+
+        result = subprocess.run(f"{SHTUFF} has receiver", shell=True)
+        self.assertEqual(result.returncode, 1)
+        subprocess.run(f"{SHTUFF} has other", shell=True, check=True)
+
+    def test_shtuff_as_in_supervised_shell_without_receiver_token(self):
+        supervisor = self.start_daemon("supervisor")
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver --supervised")
+        receiver.expect("\\$")
+
+        receiver.sendline(f"env -u SHTUFF_RECEIVER {SHTUFF} as other; echo d''one")
+        receiver.expect("is SHTUFF_RECEIVER unset")
+        receiver.expect("done")
+        result = subprocess.run(f"{SHTUFF} has other", shell=True)
+        self.assertEqual(result.returncode, 1)
+
+        # Senders that fall back to waking it up with SIGUSR1 don't kill it.
+        os.kill(supervisor.pid, signal.SIGUSR1)
+        subprocess.run(f"{SHTUFF} into receiver 'echo f\"\"oo'", shell=True, check=True)
+        receiver.expect("foo")
+
+    def test_shtuff_supervisor_keeps_relaying_while_clients_dawdle(self):
+        self.start_daemon("supervisor")
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver --supervised")
+        receiver.expect("\\$")
+
+        # Connections that never get around to sending a request.
+        socket_file = os.path.join(
+            os.environ["XDG_DATA_HOME"], "shtuff/supervisor.sock"
+        )
+        for _ in range(5):
+            idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.addCleanup(idle.close)
+            idle.connect(socket_file)
+
+        start = time.monotonic()
+        subprocess.run(
+            f"{SHTUFF} into --ack receiver 'echo f\"\"oo'", shell=True, check=True
+        )
+        receiver.expect("foo")
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_shtuff_supervisor_passes_on_umask_and_rlimits(self):
+        self.start_daemon("supervisor")
+        self.assert_passes_on_umask_and_rlimits(f"{SHTUFF} as receiver --supervised")
+
+    def test_shtuff_new_supervised(self):
+        self.start_daemon("supervisor")
+        child = pexpect.spawn(f"{SHTUFF} new --supervised 'echo foo; exit'")
+        child.expect("foo")
+        child.expect(pexpect.EOF)
+
+    def test_shtuff_supervised_without_supervisor(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver --supervised")
+        receiver.expect("no shtuff supervisor is running")
+        receiver.expect("\\$")
+
+        subprocess.run(f"{SHTUFF} into receiver 'echo f\"\"oo'", shell=True, check=True)
+        receiver.expect("foo")
+
+    def test_shtuff_zygote(self):
+        zygote = self.start_daemon("zygote")
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        # The receiver was forked by the zygote, and only its thin client
+        # runs in the terminal.
+        result = subprocess.run(
+            f"{SHTUFF} ls", shell=True, check=True, capture_output=True, text=True
+        )
+        pid = int(result.stdout.split()[1])
+        self.assertNotEqual(pid, receiver.pid)
+        with open(f"/proc/{pid}/stat") as f:
+            self.assertEqual(int(f.read().rsplit(")", 1)[1].split()[1]), zygote.pid)
+
+        subprocess.run(f"{SHTUFF} into receiver 'echo f\"\"oo'", shell=True, check=True)
+        receiver.expect("foo")
+
+        receiver.setwinsize(40, 100)
+        receiver.expect("\\$")
+        receiver.sendline("stty size")
+        receiver.expect("40 100")
+
+        receiver.sendline("exit 3")
+        receiver.expect(pexpect.EOF)
+        receiver.close()
+        self.assertEqual(receiver.exitstatus, 3)
+
+    def test_shtuff_zygote_passes_on_umask_and_rlimits(self):
+        self.start_daemon("zygote")
+        self.assert_passes_on_umask_and_rlimits(f"{SHTUFF} as receiver")
+
+    def assert_passes_on_umask_and_rlimits(self, command):
+        """
+        Check that a receiver started with command (through a zygote or a
+        supervisor) has the umask and resource limits of whoever started it,
+        not those of the daemon.
+        """
+        receiver = pexpect.spawn(
+            "bash", ["-c", f"umask 0077; ulimit -Sn 123; exec {command}"]
+        )
+        receiver.expect("\\$")
+        receiver.sendline("echo umask=$(umask) nofile=$(ulimit -Sn).")
+        receiver.expect("umask=([0-9]+) nofile=([0-9]+)\\.")
+        self.assertEqual(receiver.match.groups(), (b"0077", b"123"))
+
+    def test_shtuff_new_from_zygote(self):
+        self.start_daemon("zygote")
+        child = pexpect.spawn(f"{SHTUFF} new 'echo foo; exit'")
+        child.expect("foo")
+        child.expect(pexpect.EOF)
+
     def test_shtuff_single_receiver_can_be_aliased(self):
         receiver = pexpect.spawn(f"{SHTUFF} as receiver")
         receiver.expect("\\$")
@@ -64,6 +801,154 @@ class TestShtuff(unittest.TestCase):
         subprocess.run(f"{SHTUFF} into receiverB 'echo bar'", shell=True, check=True)
         receiverB.expect("bar")
 
+    def test_shtuff_into_glob(self):
+        receiverA = pexpect.spawn(f"{SHTUFF} as build-a")
+        receiverA.expect("\\$")
+
+        receiverB = pexpect.spawn(f"{SHTUFF} as build-b")
+        receiverB.expect("\\$")
+
+        other = pexpect.spawn(f"{SHTUFF} as other")
+        other.expect("\\$")
+
+        cp = subprocess.run(
+            f"{SHTUFF} into --glob 'build-*' 'echo foo'",
+            shell=True,
+            check=True,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+        )
+        self.assertEqual(cp.stdout, "Stuffed into build-a.\nStuffed into build-b.\n")
+        receiverA.expect("foo")
+        receiverB.expect("foo")
+        other.sendline("echo b''ar")
+        other.expect("bar")
+        self.assertNotIn(b"foo", other.before)
+
+    def test_shtuff_into_group(self):
+        receiverA = pexpect.spawn(f"{SHTUFF} as receiverA --group workers")
+        receiverA.expect("\\$")
+
+        receiverB = pexpect.spawn(f"{SHTUFF} as receiverB")
+        receiverB.expect("\\$")
+        subprocess.run(
+            f"{SHTUFF} into receiverB '{SHTUFF} as aliasB -g workers'",
+            shell=True,
+            check=True,
+        )
+        receiverB.expect("\\$")
+
+        subprocess.run(
+            f"{SHTUFF} into --group workers 'echo foo'", shell=True, check=True
+        )
+        receiverA.expect("foo")
+        receiverB.expect("foo")
+
+    def test_shtuff_into_empty_group_gracefully_dies(self):
+        cp = subprocess.run(
+            f"{SHTUFF} into --group nobody 'echo foo'",
+            shell=True,
+            capture_output=True,
+            encoding="utf-8",
+        )
+        self.assertEqual(cp.returncode, 1)
+        self.assertIn("not found", cp.stderr)
+
+    def test_shtuff_has_receivers_registered_by_older_versions(self):
+        receiver = pexpect.spawn(
+            "python -c 'import setproctitle, time;"
+            ' setproctitle.setproctitle("shtuff"); print("ready"); time.sleep(30)\''
+        )
+        receiver.expect("ready")
+
+        # Older versions registered names as base64 encoded .pid files.
+        data_dir = os.path.join(os.environ["XDG_DATA_HOME"], "shtuff")
+        os.makedirs(data_dir)
+        with open(os.path.join(data_dir, "bGVnYWN5.pid"), "w") as f:
+            f.write(str(receiver.pid))
+
+        cp = subprocess.run(
+            f"{SHTUFF} has legacy",
+            shell=True,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+        )
+        self.assertIn("was found", cp.stdout)
+        self.assertNotIn("bGVnYWN5.pid", os.listdir(data_dir))
+
+    def test_shtuff_skips_broken_legacy_pid_files(self):
+        data_dir = os.path.join(os.environ["XDG_DATA_HOME"], "shtuff")
+        os.makedirs(data_dir)
+        # An empty pid file, and one whose name isn't valid base64.
+        open(os.path.join(data_dir, "Zm9v.pid"), "w").close()
+        with open(os.path.join(data_dir, "not base64!.pid"), "w") as f:
+            f.write("1")
+
+        for action in ["has foo", "ls"]:
+            cp = subprocess.run(
+                f"{SHTUFF} {action}",
+                shell=True,
+                capture_output=True,
+                encoding="utf-8",
+            )
+            self.assertNotIn("Traceback", cp.stderr)
+
+        self.assertEqual(
+            [], [name for name in os.listdir(data_dir) if name.endswith(".pid")]
+        )
+
+    def test_shtuff_ls(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        subprocess.run(
+            f"{SHTUFF} into receiver '{SHTUFF} as aliased'", shell=True, check=True
+        )
+        receiver.expect("\\$")
+
+        exited = pexpect.spawn(f"{SHTUFF} as exited")
+        exited.expect("\\$")
+        subprocess.run(f"{SHTUFF} into exited exit", shell=True, check=True)
+        exited.expect(pexpect.EOF)
+        exited.wait()
+
+        cp = subprocess.run(
+            f"{SHTUFF} ls",
+            shell=True,
+            check=True,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+        )
+        self.assertEqual(
+            cp.stdout, f"aliased\t{receiver.pid}\nreceiver\t{receiver.pid}\n"
+        )
+
+        registry = sqlite3.connect(
+            os.path.join(os.environ["XDG_DATA_HOME"], "shtuff", "registry.sqlite3")
+        )
+        names = [name for (name,) in registry.execute("SELECT name FROM receivers")]
+        self.assertNotIn("exited", names)
+
+    def test_shtuff_into_reused_pid_gracefully_dies(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        # Pretend that the receiver which registered the name died, and some
+        # other shtuff has since been given its pid.
+        registry = sqlite3.connect(
+            os.path.join(os.environ["XDG_DATA_HOME"], "shtuff", "registry.sqlite3")
+        )
+        with registry:
+            registry.execute("UPDATE receivers SET start_time = start_time - 1")
+
+        cp = subprocess.run(
+            f"{SHTUFF} into receiver 'echo foo'",
+            shell=True,
+            capture_output=True,
+            encoding="utf-8",
+        )
+        self.assertEqual(cp.returncode, 1)
+        self.assertIn("not found", cp.stderr)
+
     def test_shtuff_without_args_shows_help(self):
         child = pexpect.spawn(SHTUFF)
         child.expect("usage")
@@ -121,6 +1006,43 @@ class TestShtuff(unittest.TestCase):
         self.assertEqual(cp.returncode, 1)
         self.assertIn("not found", cp.stderr)
 
+    def test_shtuff_wait(self):
+        waiter = subprocess.Popen(f"{SHTUFF} wait one two --timeout 20", shell=True)
+        self.addCleanup(waiter.wait)
+        self.addCleanup(waiter.kill)
+
+        one = pexpect.spawn(f"{SHTUFF} as one")
+        one.expect("\\$")
+        time.sleep(0.5)
+        self.assertIsNone(waiter.poll())
+
+        two = pexpect.spawn(f"{SHTUFF} as two")
+        two.expect("\\$")
+        self.assertEqual(waiter.wait(timeout=5), 0)
+
+    def test_shtuff_wait_times_out(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as one")
+        receiver.expect("\\$")
+
+        cp = subprocess.run(
+            f"{SHTUFF} wait one two --timeout 0.5",
+            shell=True,
+            capture_output=True,
+            encoding="utf-8",
+        )
+        self.assertEqual(cp.returncode, 1)
+        self.assertEqual(cp.stderr, "Shtuff target two was not found.\n")
+
+    def test_wait_for_receivers_without_inotify(self):
+        def without_inotify(watcher, path):
+            watcher.fd = None
+
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        with mock.patch.object(shtuff.DirectoryWatcher, "__init__", without_inotify):
+            self.assertEqual(shtuff.wait_for_receivers(["receiver"], 10), set())
+            self.assertEqual(shtuff.wait_for_receivers(["other"], 0.2), {"other"})
+        receiver.expect("\\$")
+
     def test_shtuff_does_not_have_after_exit(self):
         receiver = pexpect.spawn(f"{SHTUFF} as cheezeburgerz")
         receiver.expect("\\$")
@@ -161,6 +1083,43 @@ class TestShtuff(unittest.TestCase):
         )
         receiver.expect("aliased\r\nreceiver")
 
+    def test_shtuff_whoami_uses_receiver_token(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        # No need to look through our ancestors.
+        receiver.sendline(
+            "python -c 'from unittest import mock; import shtuff; "
+            'mock.patch("shtuff.find_nearest_shtuff_process", side_effect=AssertionError).start(); '
+            "shtuff.main()' whoami"
+        )
+        receiver.expect("\rreceiver\r\n")
+
+        # Out of the shell's session, we have to. Not being the first process
+        # in its pipeline, python isn't a process group leader, so it's
+        # allowed to start a session of its own.
+        receiver.sendline(
+            "true | python -c 'import os, shtuff; os.setsid(); shtuff.main()' whoami"
+        )
+        receiver.expect("\rreceiver\r\n")
+
+    def test_shtuff_ignores_receiver_token_outside_of_receiver(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        receiver.sendline("echo token=$SHTUFF_RECEIVER.")
+        receiver.expect("token=([0-9:]+)\\.")
+        token = receiver.match.group(1).decode()
+
+        # As if it got passed on to something that isn't in the shell.
+        cp = subprocess.run(
+            f"SHTUFF_RECEIVER={token} {SHTUFF} whoami",
+            shell=True,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        self.assertEqual(cp.returncode, 1)
+        self.assertIn("this is not a shtuff shell", cp.stderr)
+
     def test_shtuff_whoami_fails_when_not_in_shtuff(self):
         cp = subprocess.run(
             f"{SHTUFF} whoami",
@@ -181,3 +1140,329 @@ class TestShtuff(unittest.TestCase):
         receiver.expect(
             "Warning: this shtuff has no name. Use 'shtuff as' to give it a name."
         )
+
+
+class TestClient(unittest.TestCase):
+    setUpClass = TestShtuff.setUpClass
+
+    def setUp(self):
+        TestShtuff.setUp(self)
+        self.client = shtuff.Client(timeout=10)
+        self.addCleanup(self.client.close)
+
+    def test_send(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        self.client.send("receiver", "echo f''oo")
+        receiver.expect("foo")
+
+        reply = self.client.send("receiver", "echo b''ar", ack=True)
+        self.assertEqual(reply, {"written": len("echo b''ar\n")})
+        receiver.expect("bar")
+
+    def test_send_cancelled(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        # In canonical mode, the terminal throws away input it has no room
+        # for, rather than making us wait until it does.
+        receiver.sendline("stty -icanon; sleep 30")
+        time.sleep(0.2)
+
+        # Fill up the shell's input, so the next command has to wait its turn.
+        big = subprocess.Popen(
+            f"head -c 200000 /dev/zero | tr '\\0' x | {SHTUFF} into -n receiver -",
+            shell=True,
+        )
+        self.addCleanup(big.wait)
+        time.sleep(0.5)
+        with ThreadPoolExecutor(1) as executor:
+            waiting = executor.submit(
+                self.client.send, "receiver", "echo n''ope", ack=True
+            )
+            time.sleep(0.5)
+            self.assertFalse(waiting.done())
+
+            subprocess.run(
+                f"{SHTUFF} into --interrupt --cancel receiver 'echo b\"\"ack'",
+                shell=True,
+                check=True,
+            )
+            self.assertEqual(waiting.result(timeout=5), {"cancelled": True})
+            self.assertEqual(big.wait(timeout=5), 0)
+
+        receiver.expect("back")
+        self.assertNotIn(b"nope", receiver.before)
+
+    def test_send_interrupt_behind_own_backlog(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        receiver.sendline("stty -icanon; sleep 30")
+        time.sleep(0.2)
+
+        with ThreadPoolExecutor(1) as executor:
+            # More than the shell's input has room for, so some of it is
+            # still waiting its turn on our connection.
+            big = executor.submit(
+                self.client.send, "receiver", b"x" * 200000, newline=False
+            )
+            time.sleep(0.5)
+
+            start = time.monotonic()
+            reply = self.client.send(
+                "receiver", "echo b''ack", ack=True, interrupt=True, cancel=True
+            )
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertEqual(reply, {"written": len("echo b''ack\n")})
+            big.result(timeout=5)
+
+        receiver.expect("back")
+
+    def test_send_batch(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        replies = self.client.send_batch(
+            "receiver", ["echo f''oo", "echo b''ar"], ack=True
+        )
+        self.assertEqual(
+            replies,
+            [{"written": len("echo f''oo\n")}, {"written": len("echo b''ar\n")}],
+        )
+        receiver.expect("foo")
+        receiver.expect("bar")
+
+    def test_send_to_missing_receiver(self):
+        with self.assertRaises(shtuff.TargetNotFoundError):
+            self.client.send("nobody", "echo foo")
+
+    def test_send_after_receiver_is_replaced(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+        self.client.send("receiver", "echo f''oo", ack=True)
+        receiver.expect("foo")
+
+        receiver.sendline("exit")
+        receiver.expect(pexpect.EOF)
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        self.client.send("receiver", "echo b''ar", ack=True)
+        receiver.expect("bar")
+
+    def test_has_and_ls(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        self.assertTrue(self.client.has("receiver"))
+        self.assertFalse(self.client.has("nobody"))
+        self.assertEqual(self.client.ls(), {"receiver": receiver.pid})
+
+
+class TestAsyncClient(unittest.TestCase):
+    setUpClass = TestShtuff.setUpClass
+
+    def setUp(self):
+        TestClient.setUp(self)
+        self.client = shtuff.AsyncClient(concurrency=2)
+
+    def test_send_to_many(self):
+        receivers = []
+        for i in range(3):
+            receiver = pexpect.spawn(f"{SHTUFF} as receiver-{i}")
+            receiver.expect("\\$")
+            receivers.append(receiver)
+
+        async def send_to_all():
+            return await asyncio.gather(
+                *(
+                    self.client.send(f"receiver-{i}", f"echo f''oo-{i}", ack=True)
+                    for i in range(3)
+                )
+            )
+
+        replies = asyncio.run(send_to_all())
+        self.assertEqual(replies, [{"written": len("echo f''oo-0\n")}] * 3)
+        for i, receiver in enumerate(receivers):
+            receiver.expect(f"foo-{i}")
+
+    def test_send_to_missing_receiver(self):
+        with self.assertRaises(shtuff.TargetNotFoundError):
+            asyncio.run(self.client.send("nobody", "echo foo"))
+
+    def test_has(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        self.assertTrue(asyncio.run(self.client.has("receiver")))
+        self.assertFalse(asyncio.run(self.client.has("nobody")))
+
+    def test_lookups_do_not_block_the_event_loop(self):
+        # A broker that accepts connections but never answers.
+        broker = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(broker.close)
+        broker.bind(shtuff.get_broker_socket_file())
+        broker.listen(16)
+
+        async def look_up_while_ticking():
+            # How long the event loop went without getting back to us.
+            lookups = asyncio.gather(*(self.client.has("nobody") for _ in range(3)))
+            longest = 0
+            while not lookups.done():
+                start = time.monotonic()
+                await asyncio.sleep(0.01)
+                longest = max(longest, time.monotonic() - start)
+            return await lookups, longest
+
+        found, longest = asyncio.run(look_up_while_ticking())
+        self.assertEqual(found, [False] * 3)
+        self.assertLess(longest, shtuff.BROKER_TIMEOUT / 2)
+
+    def test_wait_ready(self):
+        async def start_and_wait():
+            waiting = asyncio.ensure_future(self.client.wait_ready("receiver", 10))
+            await asyncio.sleep(0.2)
+            self.assertFalse(waiting.done())
+            receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+            await waiting
+            return receiver
+
+        receiver = asyncio.run(start_and_wait())
+        self.assertTrue(asyncio.run(self.client.has("receiver")))
+        receiver.expect("\\$")
+
+    def test_wait_ready_times_out(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(self.client.wait_ready("nobody", 0.2))
+
+    def test_wait_ready_only_looks_when_something_registers(self):
+        with mock.patch.object(
+            shtuff, "find_live_receiver", wraps=shtuff.find_live_receiver
+        ) as find_live_receiver:
+            with self.assertRaises(asyncio.TimeoutError):
+                asyncio.run(self.client.wait_ready("nobody", 0.5))
+
+        self.assertEqual(find_live_receiver.call_count, 1)
+
+    def test_follow(self):
+        receiver = pexpect.spawn(f"{SHTUFF} as receiver")
+        receiver.expect("\\$")
+
+        async def follow_after_sending():
+            # Make sure we're following before anything gets printed.
+            following = self.client.follow("receiver").__aiter__()
+            first = asyncio.ensure_future(following.__anext__())
+            await asyncio.sleep(0.2)
+            await self.client.send("receiver", "echo f''oo")
+            output = await first
+            while b"foo" not in output:
+                output += await following.__anext__()
+            await following.aclose()
+            return output
+
+        output = asyncio.run(asyncio.wait_for(follow_after_sending(), 10))
+        self.assertIn(b"foo", output)
+
+
+class TestRingBuffer(unittest.TestCase):
+    def test_read_before_full(self):
+        ring = RingBuffer(8)
+        ring.write(b"abc")
+        self.assertEqual(ring.read(), b"abc")
+        self.assertEqual(ring.read(2), b"bc")
+
+    def test_wraps_around(self):
+        ring = RingBuffer(8)
+        ring.write(b"abcdef")
+        ring.write(b"ghij")
+        self.assertEqual(ring.read(), b"cdefghij")
+        self.assertEqual(ring.read(3), b"hij")
+
+    def test_write_bigger_than_buffer(self):
+        ring = RingBuffer(4)
+        ring.write(b"a")
+        ring.write(b"bcdefg")
+        self.assertEqual(ring.read(), b"defg")
+        self.assertEqual(ring.read(100), b"defg")
+
+
+class TestRelay(unittest.TestCase):
+    """
+    Drives a Relay by hand, with a pty we read from ourselves standing in for
+    the child. Until we read from it, the pty's input buffer fills up, so
+    stuffed commands back up in the relay.
+    """
+
+    BIG = 256 * 1024
+
+    def setUp(self):
+        import tty
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.slave, False)
+        stdin_r, stdin_w = os.pipe()
+        stdout_r, stdout_w = os.pipe()
+        for fd in (self.master, self.slave, stdin_r, stdin_w, stdout_r, stdout_w):
+            self.addCleanup(os.close, fd)
+
+        self.relay = shtuff.Relay(self.master, stdin_r, stdout_w)
+        self.relay.start()
+        self.addCleanup(self.relay.stop)
+
+    def spin(self):
+        for key, events in self.relay.selector.select(0.01):
+            key.data(events)
+        self.relay.update()
+
+    def read_child(self):
+        """
+        Return everything that gets stuffed into the child from now on,
+        until the relay has nothing left to stuff.
+        """
+        received = bytearray()
+        self.relay.update()
+        while True:
+            try:
+                received += os.read(self.slave, 64 * 1024)
+            except BlockingIOError:
+                if not self.relay.next_stuffing():
+                    return bytes(received)
+            self.spin()
+
+    def stuff_big(self):
+        self.relay.stuff(b"x" * self.BIG)
+        for _ in range(10):
+            self.spin()
+
+    def test_priority_goes_ahead_of_waiting_commands(self):
+        self.stuff_big()
+        self.relay.stuff(b"second\n")
+        self.relay.stuff(b"first\n", priority=shtuff.get_priority_options(True))
+
+        # It doesn't cut into the command that's halfway written, though.
+        self.assertEqual(self.read_child(), b"x" * self.BIG + b"first\n" + b"second\n")
+
+    def test_interrupt(self):
+        self.stuff_big()
+        self.relay.stuff(b"second\n")
+        priority = shtuff.get_priority_options(interrupt=True)
+        self.relay.stuff(b"first\n", priority=priority)
+
+        received = self.read_child()
+        self.assertTrue(received.endswith(b"\x03first\nsecond\n"))
+        self.assertLess(received.count(b"x"), self.BIG)
+        self.assertEqual(self.relay.stats.cancelled, 1)
+
+    def test_cancel(self):
+        self.stuff_big()
+        self.relay.stuff(b"second\n")
+        self.relay.stuff(b"third\n")
+        self.relay.stuff(b"first\n", priority=shtuff.get_priority_options(cancel=True))
+
+        self.assertEqual(self.read_child(), b"x" * self.BIG + b"first\n")
+        self.assertEqual(self.relay.stats.cancelled, 2)